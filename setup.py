@@ -11,17 +11,16 @@ setup(
     packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
     install_requires=[
-        'Django>=1.11',
-        'wechatpy[cryptography]==1.8.14'
+        'Django>=2.2',
+        'wechatpy[cryptography]==1.8.14',
+        'openpyxl',
+        'pypinyin',
     ],
     python_requires=">=3.5",
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',
         'Framework :: Django',
-        'Framework :: Django :: 1.11',
-        'Framework :: Django :: 2.0',
-        'Framework :: Django :: 2.1',
         'Framework :: Django :: 2.2',
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
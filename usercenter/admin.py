@@ -4,6 +4,7 @@ from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group
 from django_mptt_admin.admin import DjangoMpttAdmin
 from . import models
+from .search import NgramSearchAdminMixin
 
 try:
     admin.site.unregister(Group)
@@ -11,9 +12,9 @@ except:
     pass
 
 @admin.register(models.User)
-class UserAdmin(UserAdmin):
+class UserAdmin(NgramSearchAdminMixin, UserAdmin):
     list_display = ['username', 'full_name', 'department', 'employee_position', 'is_active', 'is_superuser']
-    search_fields = ('username', 'full_name', 'email', 'mobile',)
+    search_fields = ('username', 'full_name', 'email', 'mobile', 'inner_code', 'pid',)
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
         (_('Personal info'), {'fields': ('department', 'full_name', 'mobile', 'phone', 'employee_position', 'email', )}),
@@ -45,9 +46,23 @@ class UserLoginLogAdmin(admin.ModelAdmin):
     readonly_fields = ['username', 'full_name', 'ipaddress', 'login_time', 'user']
 
 
+@admin.register(models.UserLoginDaily)
+class UserLoginDailyAdmin(admin.ModelAdmin):
+    list_display = ['date', 'user', 'department', 'login_type']
+    list_filter = ['login_type']
+    raw_id_fields = ['user', 'department']
+
+
+@admin.register(models.DepartmentMembership)
+class DepartmentMembershipAdmin(admin.ModelAdmin):
+    list_display = ['user', 'department', 'valid_from', 'valid_to']
+    raw_id_fields = ['user', 'department']
+
+
 @admin.register(models.UserRequire)
-class UserRequireAdmin(admin.ModelAdmin):
+class UserRequireAdmin(NgramSearchAdminMixin, admin.ModelAdmin):
     list_display = ['full_name', 'department', 'phone', 'group']
+    search_fields = ('full_name', 'phone',)
 
 
 @admin.register(models.LeaveRequire)
@@ -78,3 +93,19 @@ class FuncPermissionAdmin(admin.ModelAdmin):
 class PhoneAccessAdmin(admin.ModelAdmin):
     list_display = ['create_time', 'phone', 'phone_access',]
     ordering = ('-create_time',)
+
+
+@admin.register(models.SMSJob)
+class SMSJobAdmin(admin.ModelAdmin):
+    list_display = ['create_time', 'template_id', 'department', 'state', 'total', 'sent', 'failed']
+    list_filter = ['state']
+    readonly_fields = ['state', 'total', 'sent', 'failed', 'create_user', 'finish_time']
+
+
+@admin.register(models.SMSRecord)
+class SMSRecordAdmin(admin.ModelAdmin):
+    list_display = ['create_time', 'phone', 'success', 'detail', 'job']
+    list_filter = ['success']
+    raw_id_fields = ['job']
+    search_fields = ('phone',)
+    ordering = ('-create_time',)
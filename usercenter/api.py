@@ -1,11 +1,34 @@
+import datetime
+
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField
+from django.db.models.functions import Coalesce, TruncWeek
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets, permissions, filters
+from rest_framework import viewsets, permissions, filters, status
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import AllowAny
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from usercenter.models import FuncGroup
+from .bulk import approve_user_requires, transfer_users
+from .cache import DEPARTMENT_TREE_VERSION, get_department_tree, get_version
 from .filters import UserFilterSet
+from .exporter import EXPORT_TYPES, export_response
+from .importer import UserImporter, read_rows
+from .pagination import CursorPaginationMixin, StreamingListMixin
 from .permissions import CsrfExemptSessionAuthentication, BasicAuthentication
+from .picker import index as user_picker_index
+from .scope import (
+    DataScopeMixin, apply_scope, check_department_scope, check_user_scope, get_scope_department_ids,
+)
+from .search import NgramSearchFilter
+from .sms import dispatch_job
+from .throttling import IPTokenBucketThrottle, PhoneTokenBucketThrottle
 from . import models
 from . import serializers
 
@@ -30,33 +53,96 @@ class ChangePasswordApi(viewsets.GenericViewSet):
             return Response({'error': True, 'msg': '原密码不正确'})
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(DataScopeMixin, CursorPaginationMixin, StreamingListMixin, viewsets.ModelViewSet):
     """用户API"""
 
     queryset = models.User.objects.exclude(username='AnonymousUser', is_active=False)
     serializer_class = serializers.UserSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, NgramSearchFilter]
     filterset_class = UserFilterSet
-    search_fields = ['full_name', 'mobile']
+    search_fields = ['full_name', 'mobile', 'username', 'inner_code', 'pid', 'email']
+    cursor_ordering = ('cursor_department', 'cursor_sort_num', '-pk')
+
+    def get_queryset(self):
+        return super().get_queryset().with_serializer_related()
+
+    def get_cursor_queryset(self, queryset):
+        return queryset.annotate(
+            cursor_department=Coalesce('department', 0, output_field=IntegerField()),
+            cursor_sort_num=Coalesce('sort_num', 0, output_field=IntegerField()),
+        )
 
     def perform_create(self, serializer):
-        super().perform_create(serializer)
+        check_department_scope(self.request.user, serializer.validated_data.get('department'))
         if self.request.data.get('password'):
-            serializer.instance.set_password(self.request.data.get('password'))
-            serializer.instance.save()
+            serializer.save(password=make_password(self.request.data.get('password')))
+        else:
+            serializer.save()
 
     def perform_update(self, serializer):
-        super().perform_update(serializer)
+        if 'department' in serializer.validated_data:
+            check_department_scope(self.request.user, serializer.validated_data['department'])
         if self.request.data.get('password'):
-            serializer.instance.set_password(self.request.data.get('password'))
-            serializer.instance.save()
+            serializer.save(password=make_password(self.request.data.get('password')))
+        else:
+            serializer.save()
 
     def perform_destroy(self, instance):
         instance.is_active = False
         instance.save()
 
 
+class UserExportView(DataScopeMixin, viewsets.GenericViewSet):
+    """
+    用户导出API
+
+    list:
+    流式导出用户，type 为 csv、jsonl 或 xlsx，支持与用户API相同的过滤和搜索参数.
+    """
+    queryset = models.User.objects.exclude(username='AnonymousUser', is_active=False)
+    serializer_class = serializers.UserSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [DjangoFilterBackend, NgramSearchFilter]
+    filterset_class = UserFilterSet
+    search_fields = ['full_name', 'mobile', 'username', 'inner_code', 'pid', 'email']
+
+    def list(self, request, *args, **kwargs):
+        export_type = request.query_params.get('type', 'csv')
+        if export_type not in EXPORT_TYPES:
+            return Response({'error': True, 'msg': '不支持的导出类型'}, status=status.HTTP_400_BAD_REQUEST)
+        return export_response(self.filter_queryset(self.get_queryset()), export_type)
+
+
+class UserImportView(viewsets.GenericViewSet):
+    """
+    用户批量导入API
+
+    create:
+    上传 CSV 或 XLSX 文件批量创建用户，返回逐行错误.
+    """
+    queryset = models.User.objects.none()
+    serializer_class = serializers.UserImportSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return Response({'error': True, 'msg': serializer.errors})
+        upload = serializer.validated_data['file']
+        importer = UserImporter(department_ids=get_scope_department_ids(request.user))
+        # 写入前先检查所有行的部门是否在数据范围内
+        rows = read_rows(upload.file, upload.name)
+        try:
+            if importer.outside_scope(rows):
+                raise PermissionDenied('无权导入到该部门')
+        finally:
+            rows.close()
+        upload.file.seek(0)
+        result = importer.run(read_rows(upload.file, upload.name))
+        return Response({'error': bool(result['errors']), 'msg': '导入完成', **result})
+
+
 class PermissionViewSet(viewsets.ReadOnlyModelViewSet):
     """权限API"""
     queryset = models.FuncPermission.objects.all()
@@ -72,8 +158,28 @@ class GroupViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class DepartmentViewSet(viewsets.ModelViewSet):
+class DepartmentTreeCacheMixin(object):
+    """部门树按版本号缓存，带 ETag，If-None-Match 命中时返回304"""
+
+    def list(self, request, *args, **kwargs):
+        variant = self.serializer_class.__name__
+        version = get_version(DEPARTMENT_TREE_VERSION)
+        etag = '"%s-%s"' % (variant, version)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            content = get_department_tree(variant, version, self.render_tree)
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    def render_tree(self):
+        serializer = self.serializer_class(models.Department.objects.all().get_cached_trees(), many=True)
+        return JSONRenderer().render(serializer.data)
+
+
+class DepartmentViewSet(DataScopeMixin, viewsets.ModelViewSet):
     """机构部门API"""
+    data_scope_field = ''
 
     queryset = models.Department.objects.all()
     serializer_class = serializers.FlatDepartmentSerializer
@@ -83,17 +189,13 @@ class DepartmentViewSet(viewsets.ModelViewSet):
     search_fields = ('name', )
 
 
-class TreeDepartmentViewSet(viewsets.ModelViewSet):
+class TreeDepartmentViewSet(DepartmentTreeCacheMixin, viewsets.ModelViewSet):
     """树形机构部门API"""
 
     queryset = models.Department.objects.all()
     serializer_class = serializers.DepartmentSerializer
     permission_classes = [permissions.IsAuthenticated]
 
-    def list(self, request, *args, **kwargs):
-        serializer = self.serializer_class(models.Department.objects.root_nodes(), many=True)
-        return Response(serializer.data)
-
 
 class MyInfoViewSet(viewsets.mixins.ListModelMixin, viewsets.GenericViewSet):
     """我的信息API"""
@@ -116,6 +218,55 @@ class UserDepChangeViewSet(viewsets.ModelViewSet):
     search_fields = ['user__full_name']
 
 
+class UserTransferView(viewsets.GenericViewSet):
+    """
+    用户批量调动API
+
+    create:
+    将用户列表或原部门及其下级部门的所有用户调到新部门，并写入部门变更记录.
+    """
+    queryset = models.User.objects.none()
+    serializer_class = serializers.UserTransferSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return Response({'error': True, 'msg': serializer.errors})
+        check_department_scope(request.user, serializer.validated_data['department'])
+        if serializer.validated_data.get('source'):
+            check_department_scope(request.user, serializer.validated_data['source'])
+        user_pks = serializer.get_user_pks()
+        check_user_scope(request.user, user_pks)
+        count = transfer_users(user_pks, serializer.validated_data['department'])
+        return Response({'error': False, 'msg': '已调动 {} 名用户'.format(count), 'count': count})
+
+
+class DepartmentRosterView(viewsets.GenericViewSet):
+    """
+    部门历史名单API
+
+    list:
+    指定日期或期间在部门（可包含下级部门）的用户及任职区间.
+    """
+    queryset = models.DepartmentMembership.objects.all()
+    serializer_class = serializers.DepartmentRosterQuerySerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        query = self.get_serializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        check_department_scope(request.user, params['department'])
+        memberships = models.DepartmentMembership.objects.active_between(
+            params.get('date') or timezone.localdate(), params.get('end')
+        ).in_department(params['department'], params['subtree']).select_related(
+            'user', 'department'
+        ).order_by('department__lft', 'user__sort_num', 'valid_from')
+        return Response(serializers.DepartmentMembershipSerializer(memberships, many=True).data)
+
+
 class DepartmentMoveView(viewsets.GenericViewSet):
     """部门排列移动"""
     queryset = models.Department.objects.none()
@@ -140,29 +291,159 @@ class UserOrderView(viewsets.GenericViewSet):
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
+            check_user_scope(request.user, [serializer.validated_data['user'], serializer.validated_data['target']])
             serializer.save()
             return Response({'error': False, 'msg': '修改成功'})
         else:
             return Response({'error': True, 'msg': serializer.errors})
 
 
-class UserLoginLogViewSet(viewsets.mixins.ListModelMixin, viewsets.GenericViewSet):
+class UserBulkOrderView(DataScopeMixin, viewsets.GenericViewSet):
+    """
+    用户批量排序API
+
+    retrieve:
+    读取部门用户顺序及排序版本.
+
+    create:
+    按完整的用户ID列表重排部门用户.
+    """
+    queryset = models.Department.objects.all()
+    serializer_class = serializers.UserBulkOrderSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    data_scope_field = ''
+
+    def retrieve(self, request, *args, **kwargs):
+        department = self.get_object()
+        users = department.users.order_by('sort_num', '-pk').values_list('pk', flat=True)
+        return Response({
+            'department': department.pk,
+            'version': department.user_sort_version,
+            'users': list(users),
+        })
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return Response({'error': True, 'msg': serializer.errors})
+        check_department_scope(request.user, serializer.validated_data['department'])
+        try:
+            department = serializer.save()
+        except models.UserSortConflict as e:
+            return Response({'error': True, 'msg': str(e)}, status=status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            return Response({'error': True, 'msg': str(e)})
+        return Response({'error': False, 'msg': '修改成功', 'version': department.user_sort_version})
+
+
+class UserLoginLogViewSet(DataScopeMixin, CursorPaginationMixin, viewsets.mixins.ListModelMixin,
+                          viewsets.GenericViewSet):
     """用户登录日志API"""
+    data_scope_field = 'user__department'
     queryset = models.UserLoginLog.objects.all()
     serializer_class = serializers.UserLoginLogSerializer
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = (DjangoFilterBackend,)
     filterset_fields = ('user',)
+    cursor_ordering = ('-login_time', '-pk')
+    # 无过滤条件时返回估算总数
+    approximate_count = True
+
+
+class UserLoginStatView(viewsets.GenericViewSet):
+    """
+    用户登录统计API
+
+    list:
+    按天或按周统计部门及其所有下级部门的活跃用户数.
+    """
+    queryset = models.UserLoginDaily.objects.all()
+    serializer_class = serializers.UserLoginStatQuerySerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        query = self.get_serializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        end = params.get('end') or timezone.localdate()
+        start = params.get('start') or end - datetime.timedelta(days=6)
+        queryset = apply_scope(
+            models.UserLoginDaily.objects.filter(date__range=(start, end)), request.user, 'department'
+        )
+        department = params.get('department')
+        if department:
+            check_department_scope(request.user, department)
+            queryset = queryset.filter(
+                department__tree_id=department.tree_id,
+                department__lft__gte=department.lft,
+                department__rght__lte=department.rght,
+            )
+        if params.get('login_type'):
+            queryset = queryset.filter(login_type=params['login_type'])
+        period = TruncWeek('date') if params['period'] == 'week' else F('date')
+        fields = ['period', 'department'] if params['by_department'] else ['period']
+        rows = queryset.annotate(period=period).values(*fields).annotate(
+            count=Count('user', distinct=True)
+        ).order_by(*fields)
+        return Response(list(rows))
+
+
+class UserPickerView(viewsets.GenericViewSet):
+    """
+    用户选择器API
+
+    list:
+    按前缀匹配在职用户，返回用户ID、姓名和部门，从进程内索引读取.
+    """
+    queryset = models.User.objects.none()
+    serializer_class = serializers.UserPickerQuerySerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        query = self.get_serializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return Response(user_picker_index.search(
+            query.validated_data['q'], query.validated_data['limit'], get_scope_department_ids(request.user)
+        ))
+
+
+class SMSJobViewSet(DataScopeMixin, viewsets.mixins.CreateModelMixin, viewsets.mixins.ListModelMixin,
+                    viewsets.mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    群发短信API
+
+    create:
+    创建群发短信任务，任务在后台发送.
+
+    retrieve:
+    查询任务进度.
+    """
+    queryset = models.SMSJob.objects.all()
+    serializer_class = serializers.SMSJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        check_department_scope(self.request.user, serializer.validated_data.get('department'))
+        job = serializer.save(create_user=self.request.user)
+        transaction.on_commit(lambda: self._dispatch(job))
+
+    @staticmethod
+    def _dispatch(job):
+        if not dispatch_job(job):
+            models.SMSJob.objects.filter(pk=job.pk).update(state='失败', finish_time=timezone.now())
 
 
-class UserRequireViewSet(viewsets.ModelViewSet):
+class UserRequireViewSet(DataScopeMixin, CursorPaginationMixin, viewsets.ModelViewSet):
     """用户申请API"""
     queryset = models.UserRequire.objects.order_by('-create_time')
     serializer_class = serializers.UserRequireSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, NgramSearchFilter]
     filterset_fields = ['state', 'department']
     search_fields = ['full_name', 'phone']
+    cursor_ordering = ('-create_time', '-pk')
 
 
 class UserRequireCreateView(viewsets.mixins.CreateModelMixin, viewsets.GenericViewSet):
@@ -171,9 +452,12 @@ class UserRequireCreateView(viewsets.mixins.CreateModelMixin, viewsets.GenericVi
     serializer_class = serializers.UserRequireCreateSerializer
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication,)
     permission_classes = (AllowAny, )
+    throttle_classes = (IPTokenBucketThrottle, PhoneTokenBucketThrottle)
+    throttle_scope = 'userrequire'
 
 
-class UserRequireDepartmentListView(viewsets.mixins.ListModelMixin, viewsets.GenericViewSet):
+class UserRequireDepartmentListView(DepartmentTreeCacheMixin, viewsets.mixins.ListModelMixin,
+                                    viewsets.GenericViewSet):
     """用户申请门店信息API"""
     queryset = models.Department.objects.root_nodes()
     serializer_class = serializers.DepartmentMiniSerializer
@@ -194,6 +478,29 @@ class UserRequirePassView(viewsets.mixins.UpdateModelMixin, viewsets.GenericView
     permission_classes = [permissions.IsAuthenticated]
 
 
+class UserRequireBulkPassView(viewsets.GenericViewSet):
+    """
+    用户申请批量通过API
+
+    create:
+    批量通过用户申请并创建用户，返回通过的申请ID和逐条错误.
+    """
+    queryset = models.UserRequire.objects.none()
+    serializer_class = serializers.UserRequireBulkPassSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return Response({'error': True, 'msg': serializer.errors})
+        try:
+            approved, errors = approve_user_requires(serializer.validated_data['requires'], request.user)
+        except IntegrityError:
+            return Response({'error': True, 'msg': '手机号码已被占用，请重试'})
+        return Response({'error': False, 'msg': '已通过 {} 条申请'.format(len(approved)),
+                         'approved': approved, 'errors': errors})
+
+
 class LeaveRequireViewSet(viewsets.ModelViewSet):
     """离职申请API"""
     queryset = models.LeaveRequire.objects.all()
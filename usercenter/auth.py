@@ -1,12 +1,8 @@
 import logging
-import datetime
+import warnings
 
-from django.conf import settings
 from django.contrib.auth.signals import user_logged_in
 from wechatpy import WeChatClientException
-from wechatpy.client import WeChatClient
-from wechatpy.session.redisstorage import RedisStorage
-from redis import Redis
 from rest_framework import serializers, fields, status, viewsets
 from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import AllowAny
@@ -15,8 +11,12 @@ from rest_framework_jwt.serializers import JSONWebTokenSerializer
 from rest_framework_jwt.settings import api_settings
 from rest_framework_jwt.views import ObtainJSONWebToken
 
-from .models import PhoneAccess, User
+from .clients import get_wxa_client
+from .models import User
+from .otp import get_otp_store
 from .permissions import CsrfExemptSessionAuthentication, BasicAuthentication
+from .throttling import IPTokenBucketThrottle, PhoneTokenBucketThrottle
+from .sms import dispatch_code, generate_code, get_backend
 
 jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
 jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
@@ -33,11 +33,7 @@ class PhoneAuthenticationSerializer(serializers.Serializer):
 
     def validate(self, data):
         phone, pa = data['phone'], data['phone_access']
-        try:
-            access = PhoneAccess.objects.get(phone=phone, phone_access=pa)
-            if phone != '17704818161':
-                access.delete()
-        except PhoneAccess.DoesNotExist:
+        if not get_otp_store().verify(phone, pa):
             raise ValidationError('验证码错误')
         try:
             User.objects.get(username=phone)
@@ -65,6 +61,8 @@ class PhoneLoginViewSet(viewsets.GenericViewSet):
     queryset = User.objects.none()
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication,)
     permission_classes = (AllowAny,)
+    throttle_classes = (IPTokenBucketThrottle, PhoneTokenBucketThrottle)
+    throttle_scope = 'phonelogin'
 
     def create(self, request, *args, **kwargs):
         """手机号验证码登录API"""
@@ -90,59 +88,33 @@ class PhoneAccessViewSet(viewsets.GenericViewSet):
     serializer_class = PhoneAccessSerializer
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication,)
     permission_classes = (AllowAny,)
+    throttle_classes = (IPTokenBucketThrottle, PhoneTokenBucketThrottle)
+    throttle_scope = 'phoneauth'
 
     def create(self, request, *args, **kwargs):
         serializer = PhoneAccessSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         phone = serializer.validated_data['phone']
-        try:
-            pa = PhoneAccess.objects.get(phone=phone)
-        except PhoneAccess.DoesNotExist:
-            pa = PhoneAccess(phone=phone)
-        if phone == '17704818161':
-            pa.phone_access = '123456'
-            pa.save()
+        store = get_otp_store()
+        if phone in store.demo_codes:
             return Response(serializer.data, status=status.HTTP_201_CREATED)
-        now = datetime.datetime.now()
-        if pa.phone_access and pa.create_time > now - datetime.timedelta(seconds=60):
+        code = generate_code()
+        if not store.issue(phone, code):
             return Response({'phone': phone, 'error': '请勿短时间重复发送'}, status=status.HTTP_403_FORBIDDEN)
-        state, access = send_phone_access(phone)
-        logger.info('{}: {}'.format(state, access))
-        if not state:
-            return Response({'phone': phone, 'error': '短信发送失败'}, status=status.HTTP_403_FORBIDDEN)
-        pa.phone_access = access
-        pa.save()
+        if not dispatch_code(phone, code):
+            store.discard(phone, code)
+            return Response({'phone': phone, 'error': '短信发送繁忙，请稍后再试'}, status=status.HTTP_403_FORBIDDEN)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 def send_phone_access(phone):
-    import requests
-    import random
-    code = []
-    for i in range(6):
-        code.append(str(random.randint(0, 9)))
-    code = "".join(code)
-    sms_type = getattr(settings, 'SMS_TYPE', 'JUHE')
-    if sms_type == 'JUHE':
-        url = getattr(settings, 'SMS_URL_JUHE')
-        appkey = getattr(settings, 'SMS_APPKEY_JUHE')
-        tpl_id = getattr(settings, 'SMS_TPL_ID_JUHE')
-        if not any([url, appkey, tpl_id]):
-            logger.error('短信验证码配置错误')
-            return False, 404
-        params = {'mobile': phone, 'tpl_id': tpl_id, 'tpl_value': '#code#=' + code, 'key': appkey}
-        ret = requests.get(url, params)
-        ret_json = ret.json()
-        if ret_json.get('error_code') == 0:
-            return True, code
-        else:
-            logger.error('短信验证码错误', data=ret_json)
-            return False, code
-    if sms_type == 'TENCENT':
-        from .auth_tencent import send_phone_access
-        return send_phone_access(phone, code)
-    logger.error('SMS_TYPE 配置错误')
-    return False, code
+    """同步发送验证码，返回 (是否成功, 验证码)，已废弃，请使用 sms.get_backend().send_code"""
+    warnings.warn('send_phone_access 已废弃，请使用 sms.get_backend().send_code', DeprecationWarning, stacklevel=2)
+    code = generate_code()
+    state, detail = get_backend().send_code(phone, code)
+    if not state:
+        logger.error('短信验证码错误 {}'.format(detail))
+    return state, code
 
 
 class MyJSONWebTokenSerializer(JSONWebTokenSerializer):
@@ -174,32 +146,21 @@ class WXALoginSerializer(serializers.Serializer):
 
     def validate(self, data):
         code = data['code']
-        redis_client = Redis.from_url(getattr(settings, 'REDIS_URL'))
-        session_interface = RedisStorage(
-            redis_client,
-            prefix="wechatpy"
-        )
-        appid = getattr(settings, 'WXA_APPID')
-        secret = getattr(settings, 'WXA_SECRET')
-        if not appid or not secret:
+        wechat_client = get_wxa_client()
+        if wechat_client is None:
             raise ValidationError('微信小程序未配置')
-        wechat_client = WeChatClient(
-            appid,
-            secret,
-            session=session_interface
-        )
         try:
             data = wechat_client.wxa.code_to_session(code)
         except WeChatClientException:
             raise ValidationError('code已使用')
         try:
-            User.objects.get(wechart_oid=data['openid'])
+            data['user'] = User.objects.get(wechart_oid=data['openid'])
         except User.DoesNotExist:
             raise ValidationError('用户不存在')
         return data
 
     def create(self, validated_data):
-        user = User.objects.get(wechart_oid=validated_data['openid'])
+        user = validated_data['user']
         payload = jwt_payload_handler(user)
         token = jwt_encode_handler(payload)
         user_logged_in.send(sender=user.__class__, request=self.context['request'], user=user)
@@ -234,44 +195,30 @@ class WXABindSerializer(serializers.Serializer):
 
     def validate(self, data):
         phone, pa = data['phone'], data['phone_access']
-        try:
-            access = PhoneAccess.objects.get(phone=phone, phone_access=pa)
-            if phone != '17704818161':
-                access.delete()
-        except PhoneAccess.DoesNotExist:
+        if not get_otp_store().verify(phone, pa):
             raise ValidationError('验证码错误')
         try:
             user = User.objects.get(username=phone)
         except User.DoesNotExist:
             raise ValidationError('用户不存在')
         code = data['code']
-        redis_client = Redis.from_url(getattr(settings, 'REDIS_URL'))
-        session_interface = RedisStorage(
-            redis_client,
-            prefix="wechatpy"
-        )
-        appid = getattr(settings, 'WXA_APPID')
-        secret = getattr(settings, 'WXA_SECRET')
-        if not appid or not secret:
+        wechat_client = get_wxa_client()
+        if wechat_client is None:
             raise ValidationError('微信小程序未配置')
-        wechat_client = WeChatClient(
-            appid,
-            secret,
-            session=session_interface
-        )
         try:
             wx_data = wechat_client.wxa.code_to_session(code)
         except WeChatClientException:
             raise ValidationError('code已使用')
         users = User.objects.exclude(username=phone).filter(wechart_oid=wx_data['openid'])
-        if users:
+        if users.exists():
             raise ValidationError('其它用户已绑定此微信，请更换微信号后进行绑定')
         user.wechart_oid = wx_data['openid']
-        user.save()
+        user.save(update_fields=['wechart_oid'])
+        data['user'] = user
         return data
 
     def create(self, validated_data):
-        user = User.objects.get(username=validated_data['phone'])
+        user = validated_data['user']
         payload = jwt_payload_handler(user)
         token = jwt_encode_handler(payload)
         user_logged_in.send(sender=user.__class__, request=self.context['request'], user=user)
@@ -289,6 +236,8 @@ class WXABindViewSet(viewsets.GenericViewSet):
     queryset = User.objects.none()
     serializer_class = WXABindSerializer
     permission_classes = (AllowAny,)
+    throttle_classes = (IPTokenBucketThrottle, PhoneTokenBucketThrottle)
+    throttle_scope = 'wxabind'
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -1,5 +1,6 @@
-
 import logging
+import threading
+import warnings
 from django.conf import settings
 from tencentcloud.common import credential
 from tencentcloud.common.profile.client_profile import ClientProfile
@@ -10,37 +11,72 @@ from tencentcloud.sms.v20190711 import models as sms_models
 
 logger = logging.getLogger('restapi')
 
-def send_phone_access(phone, code):
-    secret_id = getattr(settings, 'TENCENT_CLOUD_SECRETID')
-    secret_key = getattr(settings, 'TENCENT_CLOUD_SECRETKEY')
-    sms_appid = getattr(settings, 'SMS_APPID_TENCENT')
-    sms_tplid = getattr(settings, 'SMS_TPL_ID_TENCENT')
-    sms_tpl_sign = getattr(settings, 'SMS_TPL_SIGN_TENCENT')
-    if not secret_id or not secret_key:
-        logger.error('TENCENT CLOUD 配置错误')
-        return False, 404
-    if not sms_appid or not sms_tplid or not sms_tpl_sign:
+_client = None
+_lock = threading.Lock()
+
+
+def get_sms_client():
+    """共享的腾讯云短信客户端，未配置时返回 None"""
+    global _client
+    if _client is None:
+        secret_id = getattr(settings, 'TENCENT_CLOUD_SECRETID', None)
+        secret_key = getattr(settings, 'TENCENT_CLOUD_SECRETKEY', None)
+        if not secret_id or not secret_key:
+            logger.error('TENCENT CLOUD 配置错误')
+            return None
+        with _lock:
+            if _client is None:
+                cred = credential.Credential(secret_id, secret_key)
+                http_profile = HttpProfile()
+                http_profile.endpoint = "sms.tencentcloudapi.com"
+                http_profile.reqTimeout = getattr(settings, 'SMS_TIMEOUT', 5)
+                client_profile = ClientProfile()
+                client_profile.httpProfile = http_profile
+                _client = sms_client.SmsClient(cred, "", client_profile)
+    return _client
+
+
+def send_sms(phones, template_id, params):
+    """
+    发送同一模板的短信，phones 不超过200个
+    返回 {手机号: (是否成功, 说明)}
+    """
+    sms_appid = getattr(settings, 'SMS_APPID_TENCENT', None)
+    sms_tpl_sign = getattr(settings, 'SMS_TPL_SIGN_TENCENT', None)
+    client = get_sms_client()
+    if client is None or not sms_appid or not template_id or not sms_tpl_sign:
         logger.error('TENCENT SMS 配置错误')
-        return False, 404
+        return {phone: (False, 'TENCENT SMS 配置错误') for phone in phones}
     try:
-        cred = credential.Credential(secret_id, secret_key)
-        http_profile = HttpProfile()
-        http_profile.endpoint = "sms.tencentcloudapi.com"
-        client_profile = ClientProfile()
-        client_profile.httpProfile = http_profile
-        client = sms_client.SmsClient(cred, "", client_profile)
         req = sms_models.SendSmsRequest()
         req.SmsSdkAppid = sms_appid
         req.Sign = sms_tpl_sign
         req.ExtendCode = ""
         req.SenderId = ""
-        req.PhoneNumberSet = ["+86" + phone]
-        req.TemplateID = sms_tplid
-        req.TemplateParamSet = [code]
+        req.PhoneNumberSet = ["+86" + phone for phone in phones]
+        req.TemplateID = template_id
+        req.TemplateParamSet = list(params)
         resp = client.SendSms(req)
-        if resp.SendStatusSet[0].Code != 'Ok':
-            logger.error(resp.to_json_string())
-            return False, 404
-        return True, code
     except TencentCloudSDKException as e:
         logger.error(e)
+        return {phone: (False, str(e)) for phone in phones}
+    result = {}
+    for send_status in resp.SendStatusSet:
+        phone = send_status.PhoneNumber
+        if phone.startswith('+86'):
+            phone = phone[3:]
+        result[phone] = (send_status.Code == 'Ok', send_status.Message)
+    for phone in phones:
+        result.setdefault(phone, (False, resp.to_json_string()))
+    return result
+
+
+def send_phone_access(phone, code):
+    """已废弃，请使用 sms.get_backend().send_code"""
+    from .sms import get_backend
+    warnings.warn('send_phone_access 已废弃，请使用 sms.get_backend().send_code', DeprecationWarning, stacklevel=2)
+    state, message = get_backend().send_code(phone, code)
+    if not state:
+        logger.error(message)
+        return False, 404
+    return True, code
@@ -0,0 +1,165 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from . import search
+from .cache import count_version_name, invalidate_version
+from .models import (
+    SUPPLIER_GROUP_NAME, Department, DepartmentMembership, FuncGroup, SearchToken, User, UserDepChange, UserRequire,
+)
+from .picker import record_change
+
+
+def password_hash_pool(workers):
+    """
+    计算密码哈希的进程池，只在管理命令中使用
+    Web 进程中有登录日志、短信等线程，fork 可能复制其他线程持有的锁导致死锁
+    """
+    return ProcessPoolExecutor(workers, initializer=django.setup)
+
+
+def default_hash_workers():
+    return getattr(settings, 'PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+
+
+def hash_passwords(passwords, executor=None):
+    """
+    计算密码哈希，传入进程池或线程池时并行计算，否则在当前线程计算
+    空密码返回不可用密码
+    """
+    passwords = list(passwords)
+    raw = [password for password in passwords if password]
+    if executor is not None and len(raw) > 1:
+        hashed = iter(list(executor.map(make_password, raw, chunksize=max(1, len(raw) // 32))))
+    else:
+        hashed = iter([make_password(password) for password in raw])
+    return [next(hashed) if password else make_password(None) for password in passwords]
+
+
+def bulk_create_users(users, func_groups=None, categories=None, batch_size=500):
+    """
+    批量创建用户并批量写入角色、分类关联
+    users 为未保存的用户列表，func_groups、categories 为 {用户名: [ID, ...]}
+    返回 {用户名: 用户ID}
+    """
+    User.objects.bulk_create(users, batch_size=batch_size)
+    pks = dict(User.objects.filter(
+        username__in=[user.username for user in users]
+    ).values_list('username', 'pk'))
+    group_through = User.func_groups.through
+    group_through.objects.bulk_create([
+        group_through(user_id=pks[username], funcgroup_id=group_id)
+        for username, group_ids in (func_groups or {}).items() for group_id in set(group_ids)
+    ], batch_size=batch_size)
+    category_through = User.category.through
+    category_through.objects.bulk_create([
+        category_through(user_id=pks[username], baseconfigitem_id=category_id)
+        for username, category_ids in (categories or {}).items() for category_id in set(category_ids)
+    ], batch_size=batch_size)
+    for user in users:
+        user.pk = pks[user.username]
+    SearchToken.objects.bulk_create(
+        [token for user in users for token in search.build_tokens(user)], batch_size=batch_size
+    )
+    DepartmentMembership.record_moves((user.pk, user.department_id) for user in users if user.department_id)
+    invalidate_version(count_version_name(User))
+    record_change('user', pks.values())
+    return pks
+
+
+def approve_user_requires(pks, audit_user=None):
+    """
+    批量通过用户申请
+    一次查询检查手机号冲突，密码在线程池中并行哈希，用户及角色、分类关联批量写入，申请状态一次更新
+    PBKDF2 等哈希计算时释放 GIL，线程池在 Web 进程中也可以安全使用
+    返回 (通过的申请ID列表, {申请ID: 错误信息})
+    """
+    pks = list(pks)
+    requires = {
+        require.pk: require
+        for require in UserRequire.objects.filter(pk__in=pks).prefetch_related('category')
+    }
+    errors = {pk: '申请不存在' for pk in pks if pk not in requires}
+    existing = set(User.objects.filter(
+        username__in=[require.phone for require in requires.values()]
+    ).values_list('username', flat=True))
+    pending = []
+    for require in requires.values():
+        if require.target_user_id:
+            errors[require.pk] = '申请已通过'
+        elif require.phone in existing:
+            errors[require.pk] = '该手机号码已存在！'
+        else:
+            existing.add(require.phone)
+            pending.append(require)
+    # 未填写密码或密码过短时设置不可用密码，与单个通过时的随机密码一样无法用密码登录
+    with ThreadPoolExecutor(default_hash_workers()) as executor:
+        passwords = hash_passwords(
+            (require.password if require.password and len(require.password) >= 6 else None for require in pending),
+            executor,
+        )
+    with transaction.atomic():
+        locked = set(UserRequire.objects.select_for_update().filter(
+            pk__in=[require.pk for require in pending], target_user__isnull=True
+        ).values_list('pk', flat=True))
+        users, approved = [], []
+        for require, password in zip(pending, passwords):
+            if require.pk not in locked:
+                errors[require.pk] = '申请已通过'
+                continue
+            users.append(User(username=require.phone, password=password, **require.user_fields()))
+            approved.append(require)
+        if not approved:
+            return [], errors
+        group, created = FuncGroup.objects.get_or_create(name=SUPPLIER_GROUP_NAME)
+        user_pks = bulk_create_users(
+            users,
+            {require.phone: [group.pk] for require in approved},
+            {require.phone: [category.pk for category in require.category.all()] for require in approved},
+        )
+        UserRequire.objects.filter(pk__in=[require.pk for require in approved]).update(
+            state='已同意',
+            audit_user=audit_user,
+            audit_time=timezone.now(),
+            target_user=Case(
+                *[When(pk=require.pk, then=Value(user_pks[require.phone])) for require in approved],
+                output_field=IntegerField()
+            ),
+        )
+        invalidate_version(count_version_name(UserRequire))
+    return [require.pk for require in approved], errors
+
+
+def transfer_users(user_pks, department):
+    """
+    批量调整用户部门
+    一次 UPDATE 修改部门，一次 bulk_create 写入变更记录，缓存失效每批执行一次
+    没有原部门的用户只修改部门，不写变更记录，返回调动的用户数
+    """
+    with transaction.atomic():
+        users = list(User.objects.select_for_update().filter(pk__in=user_pks).exclude(
+            department=department
+        ).values_list('pk', 'department_id'))
+        if not users:
+            return 0
+        pks = [pk for pk, old_department_id in users]
+        User.objects.filter(pk__in=pks).update(department=department)
+        DepartmentMembership.record_moves((pk, department.pk) for pk in pks)
+        UserDepChange.objects.bulk_create([
+            UserDepChange(user_id=pk, old_department_id=old_department_id, new_department=department)
+            for pk, old_department_id in users if old_department_id is not None
+        ])
+        departments = {old_department_id for pk, old_department_id in users if old_department_id is not None}
+        Department.objects.filter(pk__in=departments | {department.pk}).update(
+            user_sort_version=F('user_sort_version') + 1
+        )
+        invalidate_version(count_version_name(User))
+        invalidate_version(count_version_name(UserDepChange))
+        record_change('user', pks)
+    return len(pks)
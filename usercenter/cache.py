@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+VERSION_KEY_PREFIX = 'usercenter:version:'
+FUNC_PERM_KEY_PREFIX = 'usercenter:funcperm:'
+DEPARTMENT_TREE_KEY_PREFIX = 'usercenter:department_tree:'
+DEPARTMENT_TREE_VERSION = 'department_tree'
+
+
+class LRUCache(object):
+    """进程内LRU缓存"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_version(name):
+    """读取版本号，不存在时以当前时间初始化，避免缓存被清除后复用旧版本"""
+    key = VERSION_KEY_PREFIX + name
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name):
+    """版本号加一，返回新版本号"""
+    key = VERSION_KEY_PREFIX + name
+    try:
+        return cache.incr(key)
+    except ValueError:
+        get_version(name)
+        return cache.incr(key)
+
+
+def invalidate_version(name):
+    """版本号加一，事务提交后再加一次防止缓存未提交的数据"""
+    bump_version(name)
+    transaction.on_commit(lambda: bump_version(name))
+
+
+def count_version_name(model):
+    """分页总数缓存的模型版本号名称"""
+    return 'count:%s' % model._meta.label_lower
+
+
+# 用户功能权限缓存
+_func_perm_local = LRUCache(getattr(settings, 'FUNC_PERM_CACHE_SIZE', 1024))
+
+
+def _func_perm_version_name(user_pk):
+    return 'funcperm:%s' % user_pk
+
+
+def load_func_perms(user):
+    """从数据库读取用户的有效功能权限"""
+    from .models import FuncPermission
+    permissions = FuncPermission.objects.filter(
+        Q(user=user) | Q(funcgroup__user=user)
+    ).distinct().values_list('codename', 'name')
+    codenames, names = set(), set()
+    for codename, name in permissions:
+        codenames.add(codename)
+        names.add(name)
+    return {
+        'codenames': frozenset(codenames),
+        'names': frozenset(names),
+        'group_names': tuple(user.func_groups.values_list('name', flat=True)),
+    }
+
+
+def get_func_perms(user):
+    """
+    获取用户的有效功能权限，返回包含 codenames、names、group_names 的字典
+    进程内LRU优先，其次Django缓存，最后查询数据库
+    """
+    version = get_version(_func_perm_version_name(user.pk))
+    local = _func_perm_local.get(user.pk)
+    if local is not None and local[0] == version:
+        return local[1]
+    key = '%s%s:%s' % (FUNC_PERM_KEY_PREFIX, user.pk, version)
+    perms = cache.get(key)
+    if perms is None:
+        perms = load_func_perms(user)
+        cache.set(key, perms, getattr(settings, 'FUNC_PERM_CACHE_TIMEOUT', 3600))
+    _func_perm_local.set(user.pk, (version, perms))
+    return perms
+
+
+def _bump_func_perms(user_pks):
+    for pk in user_pks:
+        bump_version(_func_perm_version_name(pk))
+        _func_perm_local.pop(pk)
+
+
+def invalidate_func_perms(user_pks):
+    """使指定用户的功能权限缓存失效，事务提交后再失效一次防止读到未提交数据"""
+    user_pks = set(user_pks)
+    if not user_pks:
+        return
+    _bump_func_perms(user_pks)
+    transaction.on_commit(lambda: _bump_func_perms(user_pks))
+
+
+# 部门树缓存
+def get_department_tree(variant, version, render):
+    """按部门树版本号缓存渲染后的部门树，render 返回渲染后的字节串"""
+    key = '%s%s:%s' % (DEPARTMENT_TREE_KEY_PREFIX, variant, version)
+    content = cache.get(key)
+    if content is None:
+        content = render()
+        cache.set(key, content, getattr(settings, 'DEPARTMENT_TREE_CACHE_TIMEOUT', 86400))
+    return content
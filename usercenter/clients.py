@@ -0,0 +1,42 @@
+import threading
+
+from django.conf import settings
+from redis import ConnectionPool, Redis
+from wechatpy.client import WeChatClient
+from wechatpy.session.redisstorage import RedisStorage
+
+_lock = threading.RLock()
+_redis_clients = {}
+_wechat_clients = {}
+
+
+def get_redis(url=None):
+    """按 URL 共享的 Redis 客户端，同一 URL 使用同一个连接池"""
+    url = url or getattr(settings, 'REDIS_URL')
+    client = _redis_clients.get(url)
+    if client is None:
+        with _lock:
+            client = _redis_clients.get(url)
+            if client is None:
+                pool = ConnectionPool.from_url(url, max_connections=getattr(settings, 'REDIS_MAX_CONNECTIONS', None))
+                client = _redis_clients[url] = Redis(connection_pool=pool)
+    return client
+
+
+def get_wxa_client():
+    """
+    按 appid 共享的微信小程序客户端，未配置时返回 None
+    客户端内部的 requests.Session 随客户端复用
+    """
+    appid = getattr(settings, 'WXA_APPID', None)
+    secret = getattr(settings, 'WXA_SECRET', None)
+    if not appid or not secret:
+        return None
+    client = _wechat_clients.get(appid)
+    if client is None:
+        with _lock:
+            client = _wechat_clients.get(appid)
+            if client is None:
+                session = RedisStorage(get_redis(), prefix="wechatpy")
+                client = _wechat_clients[appid] = WeChatClient(appid, secret, session=session)
+    return client
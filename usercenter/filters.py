@@ -1,16 +1,33 @@
 import django_filters
+from django import forms
 
 from baseconfig.models import BaseConfigItem
 from . import models
 
 
+class UserFilterForm(forms.Form):
+
+    def clean(self):
+        data = super().clean()
+        if not data.get('as_of') and (data.get('as_of_end') or data.get('as_of_department')):
+            raise forms.ValidationError('as_of_end 和 as_of_department 需要与 as_of 一起使用')
+        return data
+
+
 class UserFilterSet(django_filters.FilterSet):
     category = django_filters.ModelMultipleChoiceFilter(
         queryset=BaseConfigItem.objects.all(), help_text='分类'
     )
+    as_of = django_filters.DateFilter(method='filter_as_of', help_text='历史日期，当天属于任意部门的用户')
+    as_of_end = django_filters.DateFilter(method='filter_as_of', help_text='历史结束日期，查询期间任意一天属于部门的用户')
+    as_of_department = django_filters.ModelChoiceFilter(
+        queryset=models.Department.objects.all(), method='filter_as_of', help_text='历史日期所在部门，不填表示任意部门'
+    )
+    as_of_subtree = django_filters.BooleanFilter(method='filter_as_of', help_text='包含下级部门')
 
     class Meta:
         model = models.User
+        form = UserFilterForm
         fields = (
             'full_name',
             'department',
@@ -19,6 +36,20 @@ class UserFilterSet(django_filters.FilterSet):
             'func_groups__name',
         )
 
+    def filter_as_of(self, queryset, name, value):
+        # 多个参数共同决定条件，在 filter_queryset 中统一处理
+        return queryset
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        data = self.form.cleaned_data
+        if data.get('as_of'):
+            memberships = models.DepartmentMembership.objects.active_between(data['as_of'], data.get('as_of_end'))
+            if data.get('as_of_department'):
+                memberships = memberships.in_department(data['as_of_department'], bool(data.get('as_of_subtree')))
+            queryset = queryset.filter(pk__in=memberships.values('user'))
+        return queryset
+
 
 class UserFullNameFilter(django_filters.FilterSet):
     full_name = django_filters.CharFilter(lookup_expr='contains', label='姓名')
@@ -1,6 +1,6 @@
 from django import forms
 
-from . import models
+from .otp import get_otp_store
 
 
 class PhoneAccessForm(forms.Form):
@@ -11,7 +11,6 @@ class PhoneAccessForm(forms.Form):
         cleaned_data = super().clean()
         phone = cleaned_data.get("phone")
         phone_access = cleaned_data.get("phone_access")
-        pa = models.PhoneAccess.objects.filter(phone=phone, phone_access=phone_access)
-        if not pa:
+        if not get_otp_store().verify(phone, phone_access, consume=False):
             raise forms.ValidationError('验证码错误')
         return cleaned_data
@@ -0,0 +1,175 @@
+import csv
+import io
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .bulk import bulk_create_users, hash_passwords, password_hash_pool
+from .models import Department, FuncGroup, User
+
+# 可导入的列，表头可以是字段名或中文名称
+IMPORT_FIELDS = (
+    'username', 'password', 'full_name', 'mobile', 'phone', 'email', 'inner_code',
+    'employee_position', 'employee_rank', 'sex', 'pid', 'join_date', 'sort_num', 'description',
+    'department', 'func_groups', 'category',
+)
+HEADER_ALIASES = {'密码': 'password', '角色': 'func_groups', '分类': 'category', '部门': 'department'}
+
+
+def _header_map():
+    headers = dict(HEADER_ALIASES)
+    for name in IMPORT_FIELDS:
+        headers[name] = name
+        headers.setdefault(str(User._meta.get_field(name).verbose_name), name)
+    return headers
+
+
+def read_rows(fileobj, filename):
+    """逐行读取 CSV 或 XLSX 文件，返回以字段名为键的字典，不关闭传入的文件"""
+    headers = _header_map()
+    text = None
+    if filename.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+        sheet = load_workbook(fileobj, read_only=True, data_only=True).active
+        rows = sheet.iter_rows(values_only=True)
+    else:
+        text = io.TextIOWrapper(fileobj, encoding='utf-8-sig')
+        rows = csv.reader(text)
+    try:
+        columns = None
+        for row in rows:
+            if columns is None:
+                columns = [headers.get(str(cell).strip()) if cell is not None else None for cell in row]
+                continue
+            yield {
+                column: value.strip() if isinstance(value, str) else value
+                for column, value in zip(columns, row) if column
+            }
+    finally:
+        if text is not None:
+            text.detach()
+
+
+def _split(value):
+    if value in (None, ''):
+        return []
+    return [item.strip() for item in str(value).replace('，', ',').split(',') if item.strip()]
+
+
+class UserImporter(object):
+    """
+    批量导入用户
+    按块校验，用户和角色、分类关联批量写入，返回逐行错误
+    workers 大于1时整个导入共用一个进程池并行计算密码哈希，只应在管理命令中使用
+    """
+
+    def __init__(self, chunk_size=500, workers=0, department_ids=None):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        # 可导入的部门ID集合，None 表示不限制
+        self.department_ids = department_ids
+        self.executor = None
+        paths = Department.get_path_names()
+        self.departments = {path: pk for pk, path in paths.items()}
+        self.departments.update({str(pk): pk for pk in paths})
+        self.groups = dict(FuncGroup.objects.values_list('name', 'pk'))
+        self.usernames = set()
+        self.created = 0
+        self.errors = []
+
+    def outside_scope(self, rows):
+        """是否有行的部门不在可导入的部门中，未填写部门也视为不在范围内"""
+        if self.department_ids is None:
+            return False
+        for row in rows:
+            department = row.get('department')
+            if department in (None, ''):
+                return True
+            department_id = self.departments.get(str(department))
+            if department_id is not None and department_id not in self.department_ids:
+                return True
+        return False
+
+    def run(self, rows):
+        if self.workers > 1:
+            self.executor = password_hash_pool(self.workers)
+        try:
+            chunk = []
+            # 第一行为表头，数据从第二行开始
+            for index, row in enumerate(rows, start=2):
+                chunk.append((index, row))
+                if len(chunk) >= self.chunk_size:
+                    self.import_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.import_chunk(chunk)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        return {'created': self.created, 'errors': self.errors}
+
+    def import_chunk(self, chunk):
+        from baseconfig.models import BaseConfigItem
+        usernames = [str(row.get('username') or '') for index, row in chunk]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        category_ids = {item for index, row in chunk for item in _split(row.get('category'))}
+        categories = set(str(pk) for pk in BaseConfigItem.objects.filter(
+            pk__in=[pk for pk in category_ids if pk.isdigit()]
+        ).values_list('pk', flat=True))
+        users, passwords, user_groups, user_categories = [], [], {}, {}
+        for index, row in chunk:
+            user, groups, row_categories, errors = self.build_user(row, existing, categories)
+            if errors:
+                self.errors.append({'row': index, 'username': row.get('username'), 'errors': errors})
+                continue
+            self.usernames.add(user.username)
+            users.append(user)
+            passwords.append(row.get('password'))
+            user_groups[user.username] = groups
+            user_categories[user.username] = row_categories
+        for user, password in zip(users, hash_passwords(passwords, self.executor)):
+            user.password = password
+        if users:
+            with transaction.atomic():
+                bulk_create_users(users, user_groups, user_categories)
+            self.created += len(users)
+
+    def build_user(self, row, existing, categories):
+        errors = {}
+        fields = {
+            name: (None if value == '' else value) for name, value in row.items()
+            if name not in ('password', 'department', 'func_groups', 'category')
+        }
+        username = str(fields.get('username') or '')
+        if not username:
+            errors['username'] = ['用户名不能为空']
+        elif username in existing or username in self.usernames:
+            errors['username'] = ['用户名已存在']
+        department = row.get('department')
+        department_id = None
+        if department not in (None, ''):
+            department_id = self.departments.get(str(department))
+            if department_id is None:
+                errors['department'] = ['部门不存在']
+        if self.department_ids is not None and department_id not in self.department_ids:
+            errors.setdefault('department', []).append('无权导入到该部门')
+        groups = []
+        for name in _split(row.get('func_groups')):
+            if name in self.groups:
+                groups.append(self.groups[name])
+            else:
+                errors.setdefault('func_groups', []).append('角色不存在：{}'.format(name))
+        row_categories = _split(row.get('category'))
+        missing = [pk for pk in row_categories if pk not in categories]
+        if missing:
+            errors['category'] = ['分类不存在：{}'.format(','.join(missing))]
+        fields['username'] = username
+        fields['full_name'] = fields.get('full_name') or ''
+        user = User(department_id=department_id, **fields)
+        try:
+            user.full_clean(exclude=['password', 'department'], validate_unique=False)
+        except ValidationError as e:
+            for name, messages in e.message_dict.items():
+                errors.setdefault(name, []).extend(messages)
+        return user, groups, [int(pk) for pk in row_categories if pk.isdigit()], errors
@@ -0,0 +1,112 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger('restapi')
+
+
+class LoginLogWriter(object):
+    """
+    登录日志缓冲写入
+    登录事件先放入内存队列，后台线程按数量或时间批量 bulk_create，进程退出时写完剩余日志
+    settings.LOGIN_LOG_SYNC 为 True 时同步写入，用于测试
+    """
+
+    def __init__(self, batch_size=100, flush_interval=2.0, max_queue_size=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(max_queue_size)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def put(self, log):
+        if getattr(settings, 'LOGIN_LOG_SYNC', False):
+            self.write([log])
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(log)
+        except queue.Full:
+            logger.warning('登录日志队列已满，直接写入')
+            self.write([log])
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # fork 后的子进程不继承父进程的线程，重新创建队列
+                self._queue = queue.Queue(self.max_queue_size)
+                self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='usercenter-loginlog', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._drain()
+            if batch:
+                self.write(batch)
+                close_old_connections()
+
+    def _drain(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, logs):
+        from .cache import bump_version, count_version_name
+        from .models import UserLoginDaily, UserLoginLog
+        try:
+            UserLoginLog.objects.bulk_create(logs, batch_size=self.batch_size)
+            bump_version(count_version_name(UserLoginLog))
+            UserLoginDaily.record(
+                (log.login_time, log.user_id, log.user.department_id if log.user else None, log.login_type)
+                for log in logs
+            )
+        except Exception:
+            logger.exception('登录日志写入失败')
+
+    def flush(self):
+        """写入队列中剩余的日志"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.write(batch)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+
+writer = LoginLogWriter(
+    batch_size=getattr(settings, 'LOGIN_LOG_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'LOGIN_LOG_FLUSH_INTERVAL', 2.0),
+    max_queue_size=getattr(settings, 'LOGIN_LOG_QUEUE_SIZE', 10000),
+)
+atexit.register(writer.stop)
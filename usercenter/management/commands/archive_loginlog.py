@@ -0,0 +1,67 @@
+import datetime
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from usercenter.cache import count_version_name, invalidate_version
+from usercenter.models import UserLoginLog
+
+FIELDS = ('pk', 'user_id', 'username', 'full_name', 'login_time', 'ipaddress', 'login_type')
+
+
+class Command(BaseCommand):
+    help = '将超过保留期的用户登录日志按月归档为 jsonl.gz 文件并从数据库删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'LOGIN_LOG_HOT_DAYS', 180),
+            help='数据库中保留最近多少天的日志',
+        )
+        parser.add_argument(
+            '--dir', default=getattr(settings, 'LOGIN_LOG_ARCHIVE_DIR', None),
+            help='归档目录，默认为 settings.LOGIN_LOG_ARCHIVE_DIR',
+        )
+        parser.add_argument('--chunk-size', type=int, default=5000, help='每批归档的行数')
+        parser.add_argument('--dry-run', action='store_true', help='只统计不归档')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        queryset = UserLoginLog.objects.filter(login_time__lt=cutoff).order_by('login_time', 'pk')
+        if options['dry_run']:
+            self.stdout.write('待归档 {} 条，截止 {}'.format(queryset.count(), cutoff))
+            return
+        archive_dir = options['dir'] or os.path.join(getattr(settings, 'BASE_DIR', '.'), 'loginlog_archive')
+        os.makedirs(archive_dir, exist_ok=True)
+        files = {}
+        total = 0
+        try:
+            while True:
+                rows = list(queryset.values(*FIELDS)[:options['chunk_size']])
+                if not rows:
+                    break
+                with transaction.atomic():
+                    for row in rows:
+                        login_time = row['login_time']
+                        if timezone.is_aware(login_time):
+                            login_time = timezone.localtime(login_time)
+                        month = login_time.strftime('%Y-%m')
+                        if month not in files:
+                            path = os.path.join(archive_dir, 'userloginlog-{}.jsonl.gz'.format(month))
+                            files[month] = gzip.open(path, 'at', encoding='utf-8')
+                        files[month].write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+                    for f in files.values():
+                        f.flush()
+                    UserLoginLog.objects.filter(pk__in=[row['pk'] for row in rows]).delete()
+                    invalidate_version(count_version_name(UserLoginLog))
+                total += len(rows)
+                self.stdout.write('已归档 {} 条'.format(total))
+        finally:
+            for f in files.values():
+                f.close()
+        self.stdout.write(self.style.SUCCESS('归档完成，共 {} 条'.format(total)))
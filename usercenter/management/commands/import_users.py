@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from usercenter.bulk import default_hash_workers
+from usercenter.importer import UserImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = '从 CSV 或 XLSX 文件批量导入用户'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV 或 XLSX 文件路径，第一行为表头')
+        parser.add_argument('--chunk-size', type=int, default=500, help='每批校验和写入的行数')
+        parser.add_argument('--workers', type=int, default=None, help='计算密码哈希的进程数')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path.lower().endswith(('.csv', '.xlsx')):
+            raise CommandError('只支持 CSV 和 XLSX 文件')
+        with open(path, 'rb') as f:
+            result = UserImporter(
+                chunk_size=options['chunk_size'], workers=options['workers'] or default_hash_workers()
+            ).run(read_rows(f, path))
+        for error in result['errors']:
+            self.stderr.write('第 {} 行 {}: {}'.format(error['row'], error['username'] or '', error['errors']))
+        self.stdout.write(self.style.SUCCESS('已导入 {} 个用户，{} 行错误'.format(
+            result['created'], len(result['errors'])
+        )))
@@ -0,0 +1,73 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from usercenter.models import DepartmentMembership, User, UserDepChange
+
+
+def _date(value):
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+def build_intervals(department_id, date_joined, changes, today):
+    """根据入职时间和按时间排序的 (变更时间, 原部门ID, 新部门ID) 重放出任职区间"""
+    intervals = []
+    start = _date(date_joined)
+    current = changes[0][1] if changes else department_id
+    for change_time, old_department_id, new_department_id in changes:
+        end = _date(change_time)
+        intervals.append((current, start, end))
+        current, start = new_department_id, end
+    # 未记录变更直接修改了部门时，从今天开始当前部门
+    if changes and current != department_id:
+        intervals.append((current, start, today))
+        current, start = department_id, today
+    intervals.append((current, start, None))
+    return [
+        (department, valid_from, valid_to) for department, valid_from, valid_to in intervals
+        if department is not None and (valid_to is None or valid_from < valid_to)
+    ]
+
+
+class Command(BaseCommand):
+    help = '根据用户部门变更记录重建用户部门任职区间'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每批处理的用户数')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        today = timezone.localdate()
+        users = User.objects.order_by('pk').values_list('pk', 'department_id', 'date_joined')
+        total, last_pk = 0, 0
+        # 整个重建在一个事务中，中途失败时保留原有数据
+        with transaction.atomic():
+            DepartmentMembership.objects.all().delete()
+            while True:
+                chunk = list(users.filter(pk__gt=last_pk)[:chunk_size])
+                if not chunk:
+                    break
+                last_pk = chunk[-1][0]
+                changes = defaultdict(list)
+                for user_id, change_time, old_department_id, new_department_id in UserDepChange.objects.filter(
+                    user__in=[pk for pk, department_id, date_joined in chunk]
+                ).order_by('create_time', 'pk').values_list(
+                    'user_id', 'create_time', 'old_department_id', 'new_department_id'
+                ):
+                    changes[user_id].append((change_time, old_department_id, new_department_id))
+                DepartmentMembership.objects.bulk_create([
+                    DepartmentMembership(
+                        user_id=pk, department_id=department, valid_from=valid_from, valid_to=valid_to
+                    )
+                    for pk, department_id, date_joined in chunk
+                    for department, valid_from, valid_to in build_intervals(
+                        department_id, date_joined, changes[pk], today
+                    )
+                ])
+                total += len(chunk)
+                self.stdout.write('已处理 {} 名用户'.format(total))
+        self.stdout.write(self.style.SUCCESS('重建完成，共 {} 名用户'.format(total)))
@@ -0,0 +1,16 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from usercenter.search import SEARCH_FIELDS, rebuild_index
+
+
+class Command(BaseCommand):
+    help = '重建用户、用户申请的搜索词元'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每批读取的对象数')
+
+    def handle(self, *args, **options):
+        for label in SEARCH_FIELDS:
+            total = rebuild_index(apps.get_model(label), options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS('{}：已索引 {} 条'.format(label, total)))
@@ -0,0 +1,30 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from usercenter.models import UserLoginDaily, UserLoginLog
+
+
+class Command(BaseCommand):
+    help = '根据用户登录日志补全每日登录汇总'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='补全最近多少天的汇总')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='每批写入的行数')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - datetime.timedelta(days=options['days'])
+        logins = UserLoginLog.objects.filter(
+            login_time__gte=since, user__isnull=False
+        ).values_list('login_time', 'user_id', 'user__department_id', 'login_type').order_by()
+        chunk, total = [], 0
+        for login in logins.iterator(chunk_size=options['chunk_size']):
+            chunk.append(login)
+            if len(chunk) >= options['chunk_size']:
+                UserLoginDaily.record(chunk)
+                total += len(chunk)
+                chunk = []
+        UserLoginDaily.record(chunk)
+        total += len(chunk)
+        self.stdout.write(self.style.SUCCESS('已处理 {} 条登录日志'.format(total)))
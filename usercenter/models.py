@@ -1,4 +1,5 @@
 import datetime
+import json
 import uuid
 
 from django.contrib.auth.models import (
@@ -9,7 +10,7 @@ from django.contrib.auth.models import (
     timezone,
     send_mail,
 )
-from django.db import models
+from django.db import models, transaction
 from mptt.models import MPTTModel, TreeForeignKey
 
 
@@ -47,8 +48,42 @@ class FuncGroup(models.Model):
         return self.name
 
 
+# 用户排序编号间隔，拖动排序时插入到相邻编号的中间
+SORT_NUM_GAP = 1024
+
+
+class UserSortConflict(ValueError):
+    """部门用户排序版本冲突"""
+
+
+class UserQuerySet(models.QuerySet):
+
+    def set_sort_order(self, pks, gap=SORT_NUM_GAP):
+        """按 pks 的顺序以固定间隔重写排序编号，只执行一条 UPDATE"""
+        if not pks:
+            return 0
+        whens = [models.When(pk=pk, then=models.Value(index * gap)) for index, pk in enumerate(pks)]
+        return self.filter(pk__in=pks).update(
+            sort_num=models.Case(*whens, output_field=models.IntegerField())
+        )
+
+    def with_serializer_related(self):
+        """一次性加载 UserSerializer 需要的关联数据，每页查询数与页大小无关"""
+        return self.select_related(
+            'department',
+            'joinrequest',
+            'joinrequest__group',
+            'joinrequest__department',
+        ).prefetch_related(
+            'category',
+            'func_groups__permissions',
+            'func_user_permissions',
+            'joinrequest__category',
+        )
+
+
 # 用户控制器
-class UserManager(BaseUserManager):
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     use_in_migrations = True
 
     def _create_user(self, username, password, **extra_fields):
@@ -224,7 +259,7 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     @property
     def category_names(self):
-        return ",".join(self.category.all().values_list('name', flat=True))
+        return ",".join(item.name for item in self.category.all())
 
     def email_user(self, subject, message, from_email=None, **kwargs):
         if self.email:
@@ -234,38 +269,85 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.full_name
 
     def move_to(self, target, position):
-        users = target.department.users.exclude(pk=self.pk).values_list('pk', flat=True).order_by('sort_num', '-pk')
-        users = list(users)
-        try:
-            target_index = users.index(target.pk)
-        except ValueError:
+        if position not in ('left', 'right') or target.department_id is None or target.pk == self.pk:
             return
+        with transaction.atomic():
+            # 锁定部门，同一部门内的排序串行执行
+            list(Department.objects.select_for_update().filter(pk=target.department_id).values_list('pk'))
+            users = User.objects.filter(department_id=target.department_id).exclude(pk=self.pk)
+            target_sort_nums = list(users.filter(pk=target.pk).values_list('sort_num', flat=True))
+            if not target_sort_nums:
+                return
+            sort_num = self._sort_num_beside(users, target.pk, target_sort_nums[0], position)
+            if sort_num is None:
+                # 相邻编号之间没有空隙，整个部门重新编号
+                User.objects.set_sort_order(list(users.order_by('sort_num', '-pk').values_list('pk', flat=True)))
+                target_sort_num = users.filter(pk=target.pk).values_list('sort_num', flat=True)[0]
+                sort_num = self._sort_num_beside(users, target.pk, target_sort_num, position)
+            User.objects.filter(pk=self.pk).update(sort_num=sort_num)
+            Department.objects.filter(pk=target.department_id).update(
+                user_sort_version=models.F('user_sort_version') + 1
+            )
+            self.sort_num = sort_num
+
+    @staticmethod
+    def _sort_num_beside(users, target_pk, target_sort_num, position):
+        """计算插入到目标用户之前或之后的排序编号，没有空隙时返回 None"""
+        if target_sort_num is None:
+            return None
         if position == 'left':
-            users = users[:target_index] + [self.pk] + users[target_index:]
-        elif position == 'right':
-            users = users[:target_index+1] + [self.pk] + users[target_index+1:]
+            neighbor = users.filter(
+                models.Q(sort_num__lt=target_sort_num) | models.Q(sort_num=target_sort_num, pk__gt=target_pk)
+            ).order_by('-sort_num', 'pk').values_list('sort_num', flat=True).first()
+            if neighbor is None:
+                return target_sort_num - SORT_NUM_GAP
         else:
-            return
-        for index, uid in enumerate(users):
-            User.objects.filter(pk=uid).update(sort_num=index)
+            neighbor = users.filter(
+                models.Q(sort_num__gt=target_sort_num) | models.Q(sort_num=target_sort_num, pk__lt=target_pk)
+            ).order_by('sort_num', '-pk').values_list('sort_num', flat=True).first()
+            if neighbor is None:
+                return target_sort_num + SORT_NUM_GAP
+        if abs(neighbor - target_sort_num) < 2:
+            return None
+        return (neighbor + target_sort_num) // 2
+
+    def _prefetched_func_perms(self):
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'func_groups' not in prefetched or 'func_user_permissions' not in prefetched:
+            return None
+        permissions = list(prefetched['func_user_permissions'])
+        for group in prefetched['func_groups']:
+            if 'permissions' not in getattr(group, '_prefetched_objects_cache', {}):
+                return None
+            permissions.extend(group.permissions.all())
+        return {
+            'codenames': frozenset(p.codename for p in permissions),
+            'names': frozenset(p.name for p in permissions),
+            'group_names': tuple(g.name for g in prefetched['func_groups']),
+        }
+
+    @property
+    def func_perms(self):
+        perms = self._prefetched_func_perms()
+        if perms is None:
+            from .cache import get_func_perms
+            perms = get_func_perms(self)
+        return perms
+
+    def has_func_perm(self, codename):
+        return codename in self.func_perms['codenames']
 
     @property
     def func_names(self):
-        group_permission_names = self.func_groups.all().values('permissions__name').distinct().values_list('permissions__name', flat=True)
-        permission_names = self.func_user_permissions.all().values_list('name', flat=True)
-        names = {*group_permission_names, *permission_names}
-        return list(names)
+        return list(self.func_perms['names'])
 
     @property
     def func_codenames(self):
-        group_permission_names = self.func_groups.all().values('permissions__codename').distinct().values_list('permissions__codename', flat=True)
-        permission_names = self.func_user_permissions.all().values_list('codename', flat=True)
-        names = {*group_permission_names, *permission_names}
-        return list(names)
+        return list(self.func_perms['codenames'])
 
     @property
     def func_group_names(self):
-        return list(self.func_groups.values_list('name', flat=True))
+        return list(self.func_perms['group_names'])
 
 
 # 机构部门模型
@@ -292,6 +374,8 @@ class Department(MPTTModel):
     open_time = models.TimeField('开门时间', default=datetime.time(9, 0, 0))
     close_time = models.TimeField('闭店时间', default=datetime.time(19, 0, 0))
 
+    user_sort_version = models.IntegerField('用户排序版本', default=0, help_text='用户排序版本，每次调整用户排序加一')
+
     class Meta:
         verbose_name = '01.机构部门'
         verbose_name_plural = verbose_name
@@ -306,6 +390,28 @@ class Department(MPTTModel):
         names = self.get_ancestors(include_self=True).values_list('name', flat=True)
         return "/".join(names)
 
+    @classmethod
+    def get_path_names(cls):
+        """所有部门的完整路径名称 {部门ID: "上级/部门"}，只查询一次"""
+        paths = {}
+        for pk, name, parent_id in cls.objects.order_by('tree_id', 'lft').values_list('pk', 'name', 'parent_id'):
+            paths[pk] = paths[parent_id] + "/" + name if parent_id in paths else name
+        return paths
+
+    def set_user_order(self, pks, version):
+        """按 pks 的顺序重排部门全部用户，version 与当前排序版本不一致时抛出 UserSortConflict"""
+        with transaction.atomic():
+            current_version = Department.objects.select_for_update().filter(
+                pk=self.pk
+            ).values_list('user_sort_version', flat=True)[0]
+            if version != current_version:
+                raise UserSortConflict('排序已被其他用户修改，请刷新后重试')
+            if set(self.users.values_list('pk', flat=True)) != set(pks):
+                raise ValueError('用户列表与部门成员不一致')
+            User.objects.set_sort_order(pks)
+            Department.objects.filter(pk=self.pk).update(user_sort_version=models.F('user_sort_version') + 1)
+            self.user_sort_version = current_version + 1
+
 
 # 用户部门变更记录
 class UserDepChange(models.Model):
@@ -331,7 +437,81 @@ class UserDepChange(models.Model):
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         super().save(force_insert, force_update, using, update_fields)
         self.user.department = self.new_department
-        self.user.save()
+        self.user.save(update_fields=['department'])
+
+
+class DepartmentMembershipQuerySet(models.QuerySet):
+
+    def active_between(self, start, end=None):
+        """在 [start, end] 期间任意一天属于部门的记录，end 为空表示 start 当天"""
+        end = end or start
+        return self.filter(valid_from__lte=end).filter(
+            models.Q(valid_to__isnull=True) | models.Q(valid_to__gt=start)
+        )
+
+    def in_department(self, department, subtree=False):
+        """部门或部门及其所有下级部门的记录"""
+        if not subtree:
+            return self.filter(department=department)
+        return self.filter(
+            department__tree_id=department.tree_id,
+            department__lft__gte=department.lft,
+            department__rght__lte=department.rght,
+        )
+
+
+# 用户部门任职区间
+class DepartmentMembership(models.Model):
+    """用户在部门的任职区间 [valid_from, valid_to)，valid_to 为空表示至今"""
+    user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='memberships', help_text='用户')
+    department = models.ForeignKey('Department', on_delete=models.CASCADE, related_name='memberships',
+                                   help_text='部门')
+    valid_from = models.DateField('开始日期', help_text='开始日期')
+    valid_to = models.DateField('结束日期', null=True, blank=True, help_text='结束日期，不含当天')
+
+    objects = DepartmentMembershipQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = '用户部门任职区间'
+        verbose_name_plural = verbose_name
+        ordering = ['user', 'valid_from']
+        indexes = [
+            models.Index(fields=['department', 'valid_from', 'valid_to']),
+            models.Index(fields=['user', 'valid_from']),
+        ]
+
+    @classmethod
+    def record_moves(cls, moves, date=None):
+        """
+        记录部门变更，moves 为 (用户ID, 新部门ID) 序列，新部门为空表示离开部门
+        关闭用户当前的区间并开始新区间，当天开始的区间直接删除，部门未变的忽略
+        没有任何区间的用户，第一个区间从入职时间（date_joined）开始
+        """
+        moves = dict(moves)
+        if not moves:
+            return
+        unchanged = set(cls.objects.filter(
+            user__in=list(moves), valid_to__isnull=True
+        ).values_list('user_id', 'department_id'))
+        moves = {user_id: department_id for user_id, department_id in moves.items()
+                 if (user_id, department_id) not in unchanged}
+        if not moves:
+            return
+        date = date or timezone.localdate()
+        current = cls.objects.filter(user__in=list(moves), valid_to__isnull=True)
+        current.filter(valid_from__gte=date).delete()
+        current.update(valid_to=date)
+        started = set(cls.objects.filter(user__in=list(moves)).values_list('user_id', flat=True).distinct())
+        joined = {
+            pk: timezone.localtime(date_joined).date() if timezone.is_aware(date_joined) else date_joined.date()
+            for pk, date_joined in User.objects.filter(
+                pk__in=[user_id for user_id in moves if user_id not in started]
+            ).values_list('pk', 'date_joined')
+        }
+        cls.objects.bulk_create([
+            cls(user_id=user_id, department_id=department_id, valid_from=min(joined.get(user_id, date), date))
+            for user_id, department_id in moves.items() if department_id is not None
+        ])
 
 
 # 用户登录记录
@@ -340,7 +520,7 @@ class UserLoginLog(models.Model):
     user = models.ForeignKey('User', on_delete=models.SET_NULL, default=None, null=True, blank=True)
     username = models.CharField(max_length=150, null=True, blank=True)
     full_name = models.CharField(max_length=150, null=True, blank=True)
-    login_time = models.DateTimeField(auto_now_add=True)
+    login_time = models.DateTimeField(default=timezone.now, editable=False)
     ipaddress = models.CharField(max_length=128, null=True, blank=True)
     login_type = models.CharField(max_length=127, null=True, blank=True, default='PC')
 
@@ -348,6 +528,45 @@ class UserLoginLog(models.Model):
         verbose_name = '08.用户登录日志'
         verbose_name_plural = verbose_name
         ordering = ['-login_time']
+        indexes = [
+            models.Index(fields=['user', '-login_time']),
+            models.Index(fields=['-login_time']),
+        ]
+
+
+# 用户每日登录汇总
+class UserLoginDaily(models.Model):
+    """用户每日登录汇总，每个用户每天每种登录方式一行，用于统计部门活跃用户数"""
+    date = models.DateField('日期', help_text='日期')
+    user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='+', help_text='用户')
+    department = models.ForeignKey('Department', on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='+', help_text='登录时所在部门')
+    login_type = models.CharField('登录方式', max_length=127, default='PC', help_text='登录方式')
+
+    class Meta:
+        verbose_name = '09.用户每日登录汇总'
+        verbose_name_plural = verbose_name
+        unique_together = ('date', 'user', 'login_type')
+        indexes = [
+            models.Index(fields=['department', 'date']),
+            models.Index(fields=['date', 'login_type']),
+        ]
+
+    @classmethod
+    def record(cls, logins):
+        """
+        记录登录，logins 为 (登录时间, 用户ID, 部门ID, 登录方式) 序列
+        已存在的 (日期, 用户, 登录方式) 忽略
+        """
+        rows = {}
+        for login_time, user_id, department_id, login_type in logins:
+            if user_id is None:
+                continue
+            if timezone.is_aware(login_time):
+                login_time = timezone.localtime(login_time)
+            key = (login_time.date(), user_id, login_type or 'PC')
+            rows[key] = cls(date=key[0], user_id=user_id, department_id=department_id, login_type=key[2])
+        cls.objects.bulk_create(rows.values(), ignore_conflicts=True)
 
 
 # 手机验证码
@@ -362,6 +581,92 @@ class PhoneAccess(models.Model):
         ordering = ['-create_time']
 
 
+# 群发短信任务
+class SMSJob(models.Model):
+    STATES = (
+        ('等待', '等待'),
+        ('发送中', '发送中'),
+        ('已完成', '已完成'),
+        ('失败', '失败'),
+    )
+    template_id = models.CharField('短信模板ID', max_length=32, help_text='短信模板ID')
+    params = models.TextField('模板参数', default='[]', help_text='模板参数，JSON数组')
+    department = models.ForeignKey(
+        'Department', on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+        help_text='部门，发送给该部门及其所有下级部门的用户'
+    )
+    func_groups = models.ManyToManyField(FuncGroup, blank=True, related_name='+', help_text='角色，不选则不限')
+    category = models.ManyToManyField(
+        'baseconfig.BaseConfigItem', blank=True, related_name='+', help_text='分类，不选则不限'
+    )
+    state = models.CharField('状态', max_length=5, choices=STATES, default='等待', help_text='状态')
+    total = models.IntegerField('接收人数', default=0, help_text='接收人数')
+    sent = models.IntegerField('成功数', default=0, help_text='成功数')
+    failed = models.IntegerField('失败数', default=0, help_text='失败数')
+    create_user = models.ForeignKey(
+        'User', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', help_text='创建用户'
+    )
+    create_time = models.DateTimeField('创建时间', auto_now_add=True, help_text='创建时间')
+    finish_time = models.DateTimeField('完成时间', null=True, blank=True, help_text='完成时间')
+
+    class Meta:
+        verbose_name = '11.群发短信'
+        verbose_name_plural = verbose_name
+        ordering = ['-create_time']
+
+    @property
+    def param_list(self):
+        return json.loads(self.params or '[]')
+
+    @param_list.setter
+    def param_list(self, value):
+        self.params = json.dumps(list(value), ensure_ascii=False)
+
+    def get_recipient_phones(self):
+        """一次查询取得接收人手机号，部门、角色、分类条件均为子查询，未选择的条件不限"""
+        users = User.objects.filter(is_active=True).exclude(mobile__isnull=True).exclude(mobile='')
+        group_rows = SMSJob.func_groups.through.objects.filter(smsjob=self.pk)
+        category_rows = SMSJob.category.through.objects.filter(smsjob=self.pk)
+        users = users.annotate(
+            any_group=~models.Exists(group_rows),
+            any_category=~models.Exists(category_rows),
+        ).filter(
+            models.Q(any_group=True) | models.Q(pk__in=User.func_groups.through.objects.filter(
+                funcgroup__in=group_rows.values('funcgroup')
+            ).values('user')),
+            models.Q(any_category=True) | models.Q(pk__in=User.category.through.objects.filter(
+                baseconfigitem__in=category_rows.values('baseconfigitem')
+            ).values('user')),
+        )
+        if self.department_id:
+            users = users.annotate(in_department=models.Exists(Department.objects.filter(
+                pk=self.department_id,
+                tree_id=models.OuterRef('department__tree_id'),
+                lft__lte=models.OuterRef('department__lft'),
+                rght__gte=models.OuterRef('department__rght'),
+            ))).filter(in_department=True)
+        return list(users.order_by().values_list('mobile', flat=True).distinct())
+
+
+# 短信发送记录
+class SMSRecord(models.Model):
+    job = models.ForeignKey(SMSJob, on_delete=models.CASCADE, null=True, blank=True,
+                            related_name='records', help_text='群发任务')
+    phone = models.CharField('手机号码', max_length=30, help_text='手机号码')
+    success = models.BooleanField('是否成功', default=False, help_text='是否成功')
+    detail = models.TextField('说明', null=True, blank=True, help_text='说明')
+    create_time = models.DateTimeField('发送时间', auto_now_add=True, help_text='发送时间')
+
+    class Meta:
+        verbose_name = '10.短信发送记录'
+        verbose_name_plural = verbose_name
+        ordering = ['-create_time']
+
+
+# 通过用户申请创建的用户所属角色
+SUPPLIER_GROUP_NAME = '供应商'
+
+
 # 用户注册申请
 class UserRequire(models.Model):
     STATES = (
@@ -456,32 +761,32 @@ class UserRequire(models.Model):
         ordering = ['-create_time']
 
     def create_user(self):
-        if User.objects.filter(username=self.phone):
+        if User.objects.filter(username=self.phone).exists():
             raise ValueError('该手机号码已存在！')
-        user = User.objects.create_user(
-            self.phone, uuid.uuid4().hex,
-            full_name=self.full_name,
-            mobile=self.phone,
-            field_01=self.field_01,
-            field_02=self.field_02,
-            field_03=self.field_03,
-            field_04=self.field_04,
-            field_05=self.field_05,
-        )
-        for i in self.category.all():
-            user.category.add(i)
-        group, created = FuncGroup.objects.get_or_create(name='供应商')
+        password = self.password if self.password and len(self.password) >= 6 else uuid.uuid4().hex
+        user = User.objects.create_user(self.phone, password, **self.user_fields())
+        user.category.add(*self.category.all())
+        group, created = FuncGroup.objects.get_or_create(name=SUPPLIER_GROUP_NAME)
         user.func_groups.add(group)
         self.target_user = user
         self.save()
-        if self.password and len(self.password) >= 6:
-            user.set_password(self.password)
-            user.save()
         return user
 
+    def user_fields(self):
+        """创建用户时从申请复制的字段"""
+        return {
+            'full_name': self.full_name,
+            'mobile': self.phone,
+            'field_01': self.field_01,
+            'field_02': self.field_02,
+            'field_03': self.field_03,
+            'field_04': self.field_04,
+            'field_05': self.field_05,
+        }
+
     @property
     def category_names(self):
-        return ",".join(self.category.all().values_list('name', flat=True))
+        return ",".join(item.name for item in self.category.all())
 
     @property
     def group_display(self):
@@ -519,3 +824,20 @@ class LeaveRequire(models.Model):
         verbose_name = '07.离职申请'
         verbose_name_plural = verbose_name
         ordering = ['-create_time']
+
+
+# 搜索索引
+class SearchToken(models.Model):
+    """搜索字段的 n-gram 词元，由 usercenter.search 维护"""
+    model = models.CharField('模型', max_length=63, help_text='模型')
+    object_id = models.IntegerField('对象ID', help_text='对象ID')
+    field = models.CharField('字段', max_length=31, help_text='字段')
+    token = models.CharField('词元', max_length=8, help_text='词元')
+
+    class Meta:
+        verbose_name = '12.搜索索引'
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['model', 'token', 'field']),
+            models.Index(fields=['model', 'object_id']),
+        ]
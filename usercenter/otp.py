@@ -0,0 +1,177 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class BaseOTPStore(object):
+    """
+    验证码存储
+    验证码按 OTP_TTL 秒过期，OTP_RESEND_INTERVAL 秒内不能重复发送，
+    同一验证码最多尝试 OTP_MAX_ATTEMPTS 次，用完后作废验证码，但仍需等待重发间隔
+    OTP_DEMO_CODES 中的演示手机号使用固定验证码，不过期、不计尝试次数、不发送短信
+    """
+    prefix = 'usercenter:otp:'
+
+    def __init__(self):
+        self.ttl = getattr(settings, 'OTP_TTL', 300)
+        self.resend_interval = getattr(settings, 'OTP_RESEND_INTERVAL', 60)
+        self.max_attempts = getattr(settings, 'OTP_MAX_ATTEMPTS', 5)
+        self.audit = getattr(settings, 'OTP_AUDIT', False)
+        self.demo_codes = getattr(settings, 'OTP_DEMO_CODES', {'17704818161': '123456'})
+
+    def key(self, kind, phone):
+        return '%s%s:%s' % (self.prefix, kind, phone)
+
+    def issue(self, phone, code, force=False):
+        """保存验证码，重发间隔内返回 False；force 为 True 时不检查重发间隔"""
+        if not self._acquire_resend(phone) and not force:
+            return False
+        self._set_code(phone, code)
+        if self.audit:
+            from .models import PhoneAccess
+            PhoneAccess.objects.update_or_create(phone=phone, defaults={'phone_access': code})
+        return True
+
+    def verify(self, phone, code, consume=True):
+        """校验验证码，consume 为 True 时校验通过即作废，并发请求只有一个能通过"""
+        if not phone or not code:
+            return False
+        if phone in self.demo_codes:
+            return code == self.demo_codes[phone]
+        if self._incr_attempts(phone) > self.max_attempts:
+            self.discard(phone, allow_resend=False)
+            return False
+        if consume:
+            return self._consume(phone, code)
+        return self._get_code(phone) == code
+
+    def discard(self, phone, code=None, allow_resend=True):
+        """作废验证码，指定 code 时只作废该验证码，allow_resend 为 True 时同时允许立即重新发送"""
+        raise NotImplementedError
+
+    def _acquire_resend(self, phone):
+        raise NotImplementedError
+
+    def _set_code(self, phone, code):
+        raise NotImplementedError
+
+    def _get_code(self, phone):
+        raise NotImplementedError
+
+    def _consume(self, phone, code):
+        raise NotImplementedError
+
+    def _incr_attempts(self, phone):
+        raise NotImplementedError
+
+
+class CacheOTPStore(BaseOTPStore):
+    """使用 Django 缓存（settings.OTP_CACHE，默认 default）存储验证码"""
+
+    def __init__(self):
+        super().__init__()
+        self.cache = caches[getattr(settings, 'OTP_CACHE', 'default')]
+
+    def discard(self, phone, code=None, allow_resend=True):
+        if code is None or self._get_code(phone) == code:
+            keys = [self.key('code', phone), self.key('attempts', phone)]
+            if allow_resend:
+                keys.append(self.key('resend', phone))
+            self.cache.delete_many(keys)
+
+    def _acquire_resend(self, phone):
+        return self.cache.add(self.key('resend', phone), 1, self.resend_interval)
+
+    def _set_code(self, phone, code):
+        self.cache.set(self.key('code', phone), code, self.ttl)
+        self.cache.delete(self.key('attempts', phone))
+
+    def _get_code(self, phone):
+        return self.cache.get(self.key('code', phone))
+
+    def _consume(self, phone, code):
+        if self._get_code(phone) != code:
+            return False
+        # add 是原子操作，同一验证码只有第一个请求能加上消费标记
+        if not self.cache.add(self.key('consumed', '%s:%s' % (phone, code)), 1, self.ttl):
+            return False
+        self.cache.delete_many([self.key('code', phone), self.key('attempts', phone)])
+        return True
+
+    def _incr_attempts(self, phone):
+        key = self.key('attempts', phone)
+        self.cache.add(key, 0, self.ttl)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            return 1
+
+
+class RedisOTPStore(BaseOTPStore):
+    """使用 Redis（settings.REDIS_URL）存储验证码"""
+
+    CONSUME_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('DEL', KEYS[1], KEYS[2])
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self):
+        from .clients import get_redis
+        super().__init__()
+        self.redis = get_redis()
+        self.consume_script = self.redis.register_script(self.CONSUME_SCRIPT)
+
+    def discard(self, phone, code=None, allow_resend=True):
+        if code is None or self._get_code(phone) == code:
+            keys = [self.key('code', phone), self.key('attempts', phone)]
+            if allow_resend:
+                keys.append(self.key('resend', phone))
+            self.redis.delete(*keys)
+
+    def _acquire_resend(self, phone):
+        return bool(self.redis.set(self.key('resend', phone), 1, ex=self.resend_interval, nx=True))
+
+    def _set_code(self, phone, code):
+        pipe = self.redis.pipeline()
+        pipe.set(self.key('code', phone), code, ex=self.ttl)
+        pipe.delete(self.key('attempts', phone))
+        pipe.execute()
+
+    def _get_code(self, phone):
+        code = self.redis.get(self.key('code', phone))
+        return code.decode() if code is not None else None
+
+    def _consume(self, phone, code):
+        return bool(self.consume_script(keys=[self.key('code', phone), self.key('attempts', phone)], args=[code]))
+
+    def _incr_attempts(self, phone):
+        pipe = self.redis.pipeline()
+        pipe.incr(self.key('attempts', phone))
+        pipe.expire(self.key('attempts', phone), self.ttl)
+        return pipe.execute()[0]
+
+
+OTP_STORES = {
+    'cache': CacheOTPStore,
+    'redis': RedisOTPStore,
+}
+
+_stores = {}
+_lock = threading.Lock()
+
+
+def get_otp_store():
+    """按 settings.OTP_STORE（cache、redis 或类路径）返回共享的验证码存储"""
+    name = getattr(settings, 'OTP_STORE', 'cache')
+    store = _stores.get(name)
+    if store is None:
+        with _lock:
+            store = _stores.get(name)
+            if store is None:
+                store = _stores[name] = (OTP_STORES.get(name) or import_string(name))()
+    return store
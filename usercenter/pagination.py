@@ -1,17 +1,254 @@
+import base64
+import datetime
+import hashlib
+import json
 from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Q, prefetch_related_objects
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, _positive_int
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
+
+from .cache import count_version_name, get_version
+
+
+def estimate_count(queryset):
+    """PostgreSQL 统计信息中的估算行数，其他数据库返回 None"""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_count(queryset, approximate=False):
+    """
+    查询集总数，返回 (总数, 是否估算)
+    按查询SQL和模型版本号缓存 COUNT_CACHE_TIMEOUT 秒；
+    approximate 为 True 且没有过滤条件时，超过 APPROXIMATE_COUNT_THRESHOLD 行的表使用估算值
+    """
+    if approximate and not queryset.query.where:
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate >= getattr(settings, 'APPROXIMATE_COUNT_THRESHOLD', 100000):
+            return estimate, True
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0, False
+    version = get_version(count_version_name(queryset.model))
+    digest = hashlib.md5('{}:{}:{!r}:{}'.format(queryset.db, sql, params, version).encode()).hexdigest()
+    key = 'usercenter:count:%s' % digest
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, getattr(settings, 'COUNT_CACHE_TIMEOUT', 30))
+    return count, False
+
+
+class CachedCountPaginator(Paginator):
+    """总数使用 get_count 缓存或估算"""
+
+    def __init__(self, *args, approximate=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.approximate = approximate
+        self.count_approximate = False
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'query'):
+            return len(self.object_list)
+        count, self.count_approximate = get_count(self.object_list, self.approximate)
+        return count
 
 
 class UCPageNumberPagination(PageNumberPagination):
+    """视图的 approximate_count 为 True 时，无过滤条件的大表返回估算总数并带 approximate 标记"""
     page_size_query_param = 'pageSize'
     page_query_param = 'page'
     page_size = None
 
+    def paginate_queryset(self, queryset, request, view=None):
+        self.django_paginator_class = partial(
+            CachedCountPaginator, approximate=getattr(view, 'approximate_count', False)
+        )
+        return super().paginate_queryset(queryset, request, view)
+
     def get_paginated_response(self, data):
-        return Response(OrderedDict([
+        response = OrderedDict([
             ('count', self.page.paginator.count),
             ('next', self.page.has_next()),
             ('previous', self.page.has_previous()),
             ('data', data)
-        ]))
+        ])
+        if self.page.paginator.count_approximate:
+            response['approximate'] = True
+        return Response(response)
+
+
+class CursorJSONEncoder(DjangoJSONEncoder):
+    """时间保留微秒，DjangoJSONEncoder 截断到毫秒会使同一毫秒内的行被游标跳过"""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class UCCursorPagination(BasePagination):
+    """
+    游标分页，按视图的 cursor_ordering 做键集查询，不执行 COUNT 和 OFFSET
+    返回与 UCPageNumberPagination 相同的 count/next/previous/data 结构，
+    next/previous 为游标字符串，count 仅在 withCount=true 时返回
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'pageSize'
+    count_query_param = 'withCount'
+    page_size = 20
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = list(view.cursor_ordering)
+        self.page_size = self.get_page_size(request)
+        self.count, self.count_approximate = None, False
+        if request.query_params.get(self.count_query_param) in ('1', 'true'):
+            self.count, self.count_approximate = get_count(queryset, getattr(view, 'approximate_count', False))
+        queryset = view.get_cursor_queryset(queryset)
+        values, reverse = self.decode_cursor(request)
+        ordering = [self.reverse_field(field) for field in self.ordering] if reverse else self.ordering
+        if values is not None:
+            queryset = queryset.filter(self.keyset_filter(ordering, values))
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+        has_next, has_previous = (True, has_more) if reverse else (has_more, values is not None)
+        self.next = self.encode_cursor(results[-1], False) if has_next and results else None
+        self.previous = self.encode_cursor(results[0], True) if has_previous and results else None
+        return results
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('count', self.count),
+            ('next', self.next),
+            ('previous', self.previous),
+            ('data', data)
+        ])
+        if self.count_approximate:
+            response['approximate'] = True
+        return Response(response)
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param], strict=True, cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    @staticmethod
+    def reverse_field(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    @staticmethod
+    def keyset_filter(ordering, values):
+        """(a, b, c) 之后的行：a > va 或 a = va 且 b > vb 或 ...，降序字段使用 <"""
+        condition = Q()
+        for index, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = '%s__%s' % (name, 'lt' if field.startswith('-') else 'gt')
+            branch = Q(**{lookup: values[index]})
+            for previous, value in zip(ordering[:index], values[:index]):
+                branch &= Q(**{previous.lstrip('-'): value})
+            condition |= branch
+        return condition
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            values, reverse = data['v'], bool(data['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound('无效的游标')
+        if len(values) != len(self.ordering):
+            raise NotFound('无效的游标')
+        return values, reverse
+
+    def encode_cursor(self, obj, reverse):
+        values = [getattr(obj, field.lstrip('-')) for field in self.ordering]
+        data = json.dumps({'v': values, 'r': reverse}, cls=CursorJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+class CursorPaginationMixin(object):
+    """请求带 cursor 参数时改用 UCCursorPagination，cursor 为空表示第一页"""
+    cursor_ordering = None
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.cursor_ordering and UCCursorPagination.cursor_query_param in self.request.query_params:
+                self._paginator = UCCursorPagination()
+            else:
+                return super().paginator
+        return self._paginator
+
+    def get_cursor_queryset(self, queryset):
+        """游标分页前处理查询集，例如为可空的排序字段添加非空注解"""
+        return queryset
+
+
+class StreamingListMixin(object):
+    """
+    未分页的列表请求以 JSON 数组流式输出
+    查询集分块读取，每块执行一次 prefetch_related 后序列化，内存占用与行数无关
+    """
+    stream_chunk_size = 500
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        if request.accepted_renderer.format != 'json':
+            serializer = self.get_serializer(queryset, many=True)
+            return Response(serializer.data)
+        return StreamingHttpResponse(self.stream_json(queryset), content_type='application/json')
+
+    def iter_chunks(self, queryset):
+        lookups = queryset._prefetch_related_lookups
+        chunk = []
+        for obj in queryset.prefetch_related(None).iterator(chunk_size=self.stream_chunk_size):
+            chunk.append(obj)
+            if len(chunk) >= self.stream_chunk_size:
+                prefetch_related_objects(chunk, *lookups)
+                yield chunk
+                chunk = []
+        if chunk:
+            prefetch_related_objects(chunk, *lookups)
+            yield chunk
+
+    def stream_json(self, queryset):
+        renderer = JSONRenderer()
+        yield b'['
+        separator = b''
+        for chunk in self.iter_chunks(queryset):
+            data = self.get_serializer(chunk, many=True).data
+            yield separator + b','.join(renderer.render(item) for item in data)
+            separator = b','
+        yield b']'
@@ -0,0 +1,149 @@
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from pypinyin import Style, lazy_pinyin
+
+from .cache import bump_version, get_version
+
+PICKER_VERSION = 'user_picker'
+PICKER_CHANGE_KEY_PREFIX = 'usercenter:user_picker:change:'
+# 影响选择器结果的用户字段，仅修改其他字段时不记录变更
+PICKER_USER_FIELDS = ('full_name', 'username', 'mobile', 'department', 'department_id', 'is_active')
+
+
+def record_change(kind, pks):
+    """
+    事务提交后记录变更，kind 为 user 或 department
+    版本号加一，变更内容按新版本号写入缓存，供各进程增量更新
+    """
+    pks = list(pks)
+    if not pks:
+        return
+
+    def record():
+        version = bump_version(PICKER_VERSION)
+        cache.set(PICKER_CHANGE_KEY_PREFIX + str(version), (kind, pks),
+                  getattr(settings, 'USER_PICKER_CHANGE_TIMEOUT', 3600))
+
+    transaction.on_commit(record)
+
+
+def search_keys(full_name, username, mobile):
+    """姓名、用户名、手机号及姓名的拼音首字母和全拼"""
+    keys = {str(value).strip().lower() for value in (full_name, username, mobile) if value}
+    if full_name:
+        keys.add(''.join(lazy_pinyin(full_name, style=Style.FIRST_LETTER)).lower())
+        keys.add(''.join(lazy_pinyin(full_name)).lower())
+    keys.discard('')
+    return keys
+
+
+class UserPickerIndex(object):
+    """
+    进程内的在职用户前缀索引
+    最多每 USER_PICKER_CHECK_INTERVAL 秒读取一次缓存中的版本号，
+    落后的版本按变更记录增量更新，变更记录缺失或落后过多时全量重建
+    """
+
+    def __init__(self, max_changes=200):
+        self.max_changes = max_changes
+        self.version = None
+        self.checked_at = 0
+        self.entries = {}
+        self.keys = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(pks=None):
+        from .models import User
+        queryset = User.objects.filter(is_active=True).exclude(username='AnonymousUser')
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
+        return queryset.values_list('pk', 'full_name', 'username', 'mobile', 'department_id', 'department__name')
+
+    @staticmethod
+    def make_entry(row):
+        pk, full_name, username, mobile, department_id, department_name = row
+        entry = {'pk': pk, 'full_name': full_name, 'department': department_id, 'department_name': department_name}
+        return entry, search_keys(full_name, username, mobile)
+
+    def rebuild(self, version):
+        entries, keys = {}, []
+        for row in self.load().iterator():
+            entry, row_keys = self.make_entry(row)
+            entries[entry['pk']] = (entry, row_keys)
+            keys.extend((key, entry['pk']) for key in row_keys)
+        keys.sort()
+        self.entries, self.keys, self.version = entries, keys, version
+
+    def apply(self, changes, version):
+        from .models import User
+        user_pks = set()
+        for kind, pks in changes:
+            if kind == 'department':
+                user_pks.update(User.objects.filter(department__in=pks).values_list('pk', flat=True))
+                user_pks.update(pk for pk, (entry, row_keys) in self.entries.items() if entry['department'] in pks)
+            else:
+                user_pks.update(pks)
+        # 复制后修改再替换，搜索中的请求读取的仍是旧列表
+        entries, keys = dict(self.entries), list(self.keys)
+        for pk in user_pks:
+            old = entries.pop(pk, None)
+            if old is not None:
+                for key in old[1]:
+                    index = bisect_left(keys, (key, pk))
+                    if index < len(keys) and keys[index] == (key, pk):
+                        del keys[index]
+        for row in self.load(user_pks):
+            entry, row_keys = self.make_entry(row)
+            entries[entry['pk']] = (entry, row_keys)
+            for key in row_keys:
+                insort(keys, (key, entry['pk']))
+        self.entries, self.keys, self.version = entries, keys, version
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.version is not None and now - self.checked_at < getattr(settings, 'USER_PICKER_CHECK_INTERVAL', 1):
+            return
+        with self._lock:
+            if self.version is not None and now - self.checked_at < getattr(settings, 'USER_PICKER_CHECK_INTERVAL', 1):
+                return
+            version = get_version(PICKER_VERSION)
+            if self.version is None or not 0 <= version - self.version <= self.max_changes:
+                self.rebuild(version)
+            elif version != self.version:
+                keys = [PICKER_CHANGE_KEY_PREFIX + str(v) for v in range(self.version + 1, version + 1)]
+                changes = cache.get_many(keys)
+                if len(changes) == len(keys):
+                    self.apply([changes[key] for key in keys], version)
+                else:
+                    self.rebuild(version)
+            self.checked_at = now
+
+    def search(self, query, limit=20, department_ids=None):
+        """按前缀匹配，返回不重复的用户，department_ids 不为 None 时只返回这些部门的用户"""
+        self.refresh()
+        query = query.strip().lower()
+        if not query:
+            return []
+        entries, keys = self.entries, self.keys
+        results, seen = [], set()
+        position = bisect_left(keys, (query,))
+        while position < len(keys) and len(results) < limit:
+            key, pk = keys[position]
+            if not key.startswith(query):
+                break
+            if pk not in seen and pk in entries:
+                seen.add(pk)
+                entry = entries[pk][0]
+                if department_ids is None or entry['department'] in department_ids:
+                    results.append(entry)
+            position += 1
+        return results
+
+
+index = UserPickerIndex()
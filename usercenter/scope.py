@@ -0,0 +1,134 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from rest_framework.exceptions import PermissionDenied
+
+from .cache import DEPARTMENT_TREE_VERSION, LRUCache, get_func_perms, get_version
+
+# 数据范围功能权限，同时拥有时取最大范围
+DATA_SCOPE_ALL = 'data_scope_all'
+DATA_SCOPE_DEPARTMENT = 'data_scope_department'
+DATA_SCOPE_KEY_PREFIX = 'usercenter:data_scope:'
+
+_scope_local = LRUCache(getattr(settings, 'DATA_SCOPE_CACHE_SIZE', 1024))
+
+
+def get_scope_name(user):
+    """
+    用户的数据范围，all 为全部数据，department 为本部门及所有下级部门
+    超级用户为 all，没有数据范围权限时使用 DATA_SCOPE_DEFAULT
+    """
+    if user.is_superuser:
+        return 'all'
+    codenames = get_func_perms(user)['codenames']
+    if DATA_SCOPE_ALL in codenames:
+        return 'all'
+    if DATA_SCOPE_DEPARTMENT in codenames:
+        return 'department'
+    return getattr(settings, 'DATA_SCOPE_DEFAULT', 'all')
+
+
+def load_department_range(department_id):
+    from .models import Department
+    return Department.objects.filter(pk=department_id).values_list('tree_id', 'lft', 'rght').first()
+
+
+def get_scope_ranges(user):
+    """
+    用户可见的部门范围 [(tree_id, lft, rght), ...]，None 表示不限制
+    按部门树版本号缓存，部门移动或用户调动部门后自动失效
+    """
+    if not user.is_authenticated:
+        return []
+    if get_scope_name(user) == 'all':
+        return None
+    if user.department_id is None:
+        return []
+    version = get_version(DEPARTMENT_TREE_VERSION)
+    local = _scope_local.get(user.department_id)
+    if local is not None and local[0] == version:
+        return local[1]
+    key = '%s%s:%s' % (DATA_SCOPE_KEY_PREFIX, user.department_id, version)
+    ranges = cache.get(key)
+    if ranges is None:
+        department_range = load_department_range(user.department_id)
+        ranges = [department_range] if department_range else []
+        cache.set(key, ranges, getattr(settings, 'DEPARTMENT_TREE_CACHE_TIMEOUT', 86400))
+    _scope_local.set(user.department_id, (version, ranges))
+    return ranges
+
+
+def scope_filter(ranges, field=''):
+    """部门范围条件，field 为指向部门的字段路径，空字符串表示部门本身"""
+    prefix = field + '__' if field else ''
+    condition = Q()
+    for tree_id, lft, rght in ranges:
+        condition |= Q(**{prefix + 'tree_id': tree_id, prefix + 'lft__gte': lft, prefix + 'rght__lte': rght})
+    return condition
+
+
+def apply_scope(queryset, user, field=''):
+    ranges = get_scope_ranges(user)
+    if ranges is None:
+        return queryset
+    if not ranges:
+        return queryset.none()
+    return queryset.filter(scope_filter(ranges, field))
+
+
+def get_scope_department_ids(user):
+    """用户可见的部门ID集合，None 表示不限制，与部门范围一样按部门树版本号缓存"""
+    from .models import Department
+    ranges = get_scope_ranges(user)
+    if ranges is None:
+        return None
+    if not ranges:
+        return frozenset()
+    version = get_version(DEPARTMENT_TREE_VERSION)
+    key = 'ids:%s' % user.department_id
+    local = _scope_local.get(key)
+    if local is not None and local[0] == version:
+        return local[1]
+    cache_key = '%sids:%s:%s' % (DATA_SCOPE_KEY_PREFIX, user.department_id, version)
+    department_ids = cache.get(cache_key)
+    if department_ids is None:
+        department_ids = frozenset(Department.objects.filter(scope_filter(ranges)).values_list('pk', flat=True))
+        cache.set(cache_key, department_ids, getattr(settings, 'DEPARTMENT_TREE_CACHE_TIMEOUT', 86400))
+    _scope_local.set(key, (version, department_ids))
+    return department_ids
+
+
+def department_in_scope(user, department):
+    """部门是否在用户的数据范围内，部门为空表示全部部门"""
+    ranges = get_scope_ranges(user)
+    if ranges is None:
+        return True
+    if department is None:
+        return False
+    return any(
+        department.tree_id == tree_id and lft <= department.lft and department.rght <= rght
+        for tree_id, lft, rght in ranges
+    )
+
+
+def check_department_scope(user, department):
+    if not department_in_scope(user, department):
+        raise PermissionDenied('无权操作该部门的数据')
+
+
+def check_user_scope(user, user_pks):
+    """用户ID列表全部在数据范围内，否则抛出 PermissionDenied"""
+    from .models import User
+    user_pks = set(user_pks)
+    if not user_pks or get_scope_ranges(user) is None:
+        return
+    if apply_scope(User.objects.filter(pk__in=user_pks), user, 'department').count() != len(user_pks):
+        raise PermissionDenied('无权操作该部门的数据')
+
+
+class DataScopeMixin(object):
+    """按当前用户的数据范围过滤查询集，data_scope_field 为指向部门的字段路径"""
+    data_scope_field = 'department'
+
+    def get_queryset(self):
+        return apply_scope(super().get_queryset(), self.request.user, self.data_scope_field)
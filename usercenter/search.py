@@ -0,0 +1,136 @@
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from rest_framework.filters import SearchFilter
+
+from .models import SearchToken, User, UserRequire
+
+# 词元最大长度，不超过该长度的搜索词直接按词元匹配
+GRAM_SIZE = 3
+
+# {模型标签: (搜索字段, 精确匹配字段)}，精确匹配字段命中时排在前面
+SEARCH_FIELDS = {}
+
+
+def register(model, fields, exact_fields=()):
+    SEARCH_FIELDS[model._meta.label_lower] = (tuple(fields), tuple(exact_fields))
+
+
+def is_registered(model):
+    return model._meta.label_lower in SEARCH_FIELDS
+
+
+def tokenize(value):
+    """长度 1 到 GRAM_SIZE 的所有子串"""
+    value = str(value).strip().lower()
+    return {
+        value[start:start + size]
+        for size in range(1, GRAM_SIZE + 1) for start in range(len(value) - size + 1)
+    }
+
+
+def build_tokens(instance, fields=None):
+    label = instance._meta.label_lower
+    tokens = []
+    for field in fields or SEARCH_FIELDS[label][0]:
+        value = getattr(instance, field)
+        if value in (None, ''):
+            continue
+        tokens.extend(
+            SearchToken(model=label, object_id=instance.pk, field=field, token=token)
+            for token in tokenize(value)
+        )
+    return tokens
+
+
+def index_object(instance, update_fields=None):
+    """重建对象的词元，update_fields 不含搜索字段时不处理"""
+    label = instance._meta.label_lower
+    fields = SEARCH_FIELDS[label][0]
+    if update_fields is not None:
+        fields = [field for field in fields if field in update_fields]
+        if not fields:
+            return
+    SearchToken.objects.filter(model=label, object_id=instance.pk, field__in=fields).delete()
+    SearchToken.objects.bulk_create(build_tokens(instance, fields))
+
+
+def unindex_object(instance):
+    SearchToken.objects.filter(model=instance._meta.label_lower, object_id=instance.pk).delete()
+
+
+def rebuild_index(model, chunk_size=1000):
+    """重建模型的全部词元，返回处理的对象数"""
+    label = model._meta.label_lower
+    fields = SEARCH_FIELDS[label][0]
+    SearchToken.objects.filter(model=label).delete()
+    total, tokens = 0, []
+    for instance in model._default_manager.only('pk', *fields).iterator(chunk_size=chunk_size):
+        tokens.extend(build_tokens(instance, fields))
+        total += 1
+        if len(tokens) >= chunk_size * 10:
+            SearchToken.objects.bulk_create(tokens, batch_size=chunk_size)
+            tokens = []
+    SearchToken.objects.bulk_create(tokens, batch_size=chunk_size)
+    return total
+
+
+def matching_ids(model, term):
+    """
+    包含搜索词的对象ID子查询
+    短词直接匹配词元；长词要求同一字段包含全部 n-gram，再用 icontains 在候选集中校验
+    """
+    label = model._meta.label_lower
+    fields = SEARCH_FIELDS[label][0]
+    term = term.lower()
+    if len(term) <= GRAM_SIZE:
+        return Q(pk__in=SearchToken.objects.filter(model=label, token=term).values('object_id'))
+    grams = {term[start:start + GRAM_SIZE] for start in range(len(term) - GRAM_SIZE + 1)}
+    candidates = SearchToken.objects.filter(model=label, token__in=grams).values('object_id', 'field').annotate(
+        matched=Count('token', distinct=True)
+    ).filter(matched=len(grams)).values('object_id')
+    contains = Q()
+    for field in fields:
+        contains |= Q(**{'%s__icontains' % field: term})
+    return Q(pk__in=candidates) & contains
+
+
+def search(queryset, terms):
+    """
+    按搜索词过滤并排序，多个搜索词同时满足
+    精确匹配字段完全相等的排最前，其次为其他字段完全相等，然后是部分匹配
+    """
+    fields, exact_fields = SEARCH_FIELDS[queryset.model._meta.label_lower]
+    whens = []
+    for term in terms:
+        queryset = queryset.filter(matching_ids(queryset.model, term))
+        whens.extend(When(**{field: term, 'then': Value(2)}) for field in exact_fields)
+        whens.extend(When(**{'%s__iexact' % field: term, 'then': Value(1)}) for field in fields
+                     if field not in exact_fields)
+    ordering = queryset.query.order_by or queryset.model._meta.ordering
+    return queryset.annotate(
+        search_rank=Case(*whens, default=Value(0), output_field=IntegerField())
+    ).order_by('-search_rank', *ordering)
+
+
+class NgramSearchFilter(SearchFilter):
+    """使用 n-gram 词元索引的搜索，参数与 SearchFilter 相同"""
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms or not is_registered(queryset.model):
+            return super().filter_queryset(request, queryset, view)
+        return search(queryset, terms)
+
+
+class NgramSearchAdminMixin(object):
+    """后台搜索使用 n-gram 词元索引"""
+
+    def get_search_results(self, request, queryset, search_term):
+        terms = search_term.replace(',', ' ').split()
+        if not terms or not is_registered(queryset.model):
+            return super().get_search_results(request, queryset, search_term)
+        return search(queryset, terms), False
+
+
+register(User, ('full_name', 'mobile', 'username', 'inner_code', 'pid', 'email'),
+         ('mobile', 'username', 'inner_code'))
+register(UserRequire, ('full_name', 'phone'), ('phone',))
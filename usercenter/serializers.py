@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth.models import Group
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
@@ -103,7 +104,8 @@ class DepartmentSerializer(serializers.ModelSerializer):
         )
 
     def get_items(self, obj):
-        children = obj.children.all()
+        # get_children 使用 get_cached_trees 缓存的子节点，叶子节点不查询
+        children = obj.get_children()
         childrens = DepartmentSerializer(children, many=True).data
         result = []
         result.extend(childrens)
@@ -131,7 +133,7 @@ class DepartmentMiniSerializer(serializers.ModelSerializer):
         )
 
     def get_items(self, obj):
-        children = obj.children.all()
+        children = obj.get_children()
         childrens = DepartmentMiniSerializer(children, many=True).data
         result = []
         result.extend(childrens)
@@ -140,7 +142,7 @@ class DepartmentMiniSerializer(serializers.ModelSerializer):
         return result
 
     def get_leaf(self, obj):
-        return not obj.children.all()
+        return obj.is_leaf_node()
 
 
 class FlatDepartmentSerializer(serializers.ModelSerializer):
@@ -230,11 +232,26 @@ class UserSerializer(serializers.ModelSerializer):
 
     def get_joinrequest(self, obj):
         try:
-            return UserRequireSerializer(models.UserRequire.objects.get(target_user=obj)).data
+            return UserRequireSerializer(obj.joinrequest).data
         except models.UserRequire.DoesNotExist:
             return None
 
 
+class UserImportSerializer(serializers.Serializer):
+    file = serializers.FileField(label='文件', help_text='CSV 或 XLSX 文件，第一行为表头')
+
+    def validate_file(self, value):
+        if not value.name.lower().endswith(('.csv', '.xlsx')):
+            raise ValidationError('只支持 CSV 和 XLSX 文件')
+        return value
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
 class UserMinSerializer(serializers.ModelSerializer):
     """用户"""
     department_name = serializers.SerializerMethodField()
@@ -306,6 +323,85 @@ class UserDepChangeSerializer(serializers.ModelSerializer):
         )
 
 
+class UserTransferSerializer(serializers.Serializer):
+    users = serializers.ListField(
+        child=serializers.IntegerField(),
+        required=False,
+        max_length=5000,
+        label='用户ID列表',
+        help_text='要调动的用户ID列表'
+    )
+    source = serializers.PrimaryKeyRelatedField(
+        queryset=models.Department.objects.all(),
+        required=False,
+        label='原部门',
+        help_text='调动该部门及其所有下级部门的用户，与用户ID列表二选一'
+    )
+    department = serializers.PrimaryKeyRelatedField(
+        queryset=models.Department.objects.all(),
+        label='新部门',
+        help_text='新部门'
+    )
+
+    def validate(self, attrs):
+        if not attrs.get('users') and not attrs.get('source'):
+            raise serializers.ValidationError('请选择用户或原部门')
+        return attrs
+
+    def get_user_pks(self):
+        if self.validated_data.get('users'):
+            return self.validated_data['users']
+        source = self.validated_data['source']
+        return list(models.User.objects.filter(
+            department__tree_id=source.tree_id,
+            department__lft__gte=source.lft,
+            department__rght__lte=source.rght,
+        ).values_list('pk', flat=True))
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
+class DepartmentRosterQuerySerializer(serializers.Serializer):
+    department = serializers.PrimaryKeyRelatedField(
+        queryset=models.Department.objects.all(),
+        help_text='部门'
+    )
+    date = serializers.DateField(required=False, help_text='日期，默认为今天')
+    end = serializers.DateField(required=False, help_text='结束日期，查询 date 到 end 期间任意一天在部门的用户')
+    subtree = serializers.BooleanField(default=False, help_text='包含下级部门')
+
+    def validate(self, attrs):
+        if attrs.get('date') and attrs.get('end') and attrs['end'] < attrs['date']:
+            raise serializers.ValidationError('结束日期不能早于开始日期')
+        return attrs
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
+class DepartmentMembershipSerializer(serializers.ModelSerializer):
+    full_name = serializers.CharField(source='user.full_name', read_only=True)
+    department_name = serializers.CharField(source='department.name', read_only=True)
+
+    class Meta:
+        model = models.DepartmentMembership
+        fields = (
+            'user',
+            'full_name',
+            'department',
+            'department_name',
+            'valid_from',
+            'valid_to',
+        )
+
+
 class DepartmentMoveSerializer(serializers.Serializer):
     POSITION_CHOICES = (
         ('first-child', '第一个子部门'),
@@ -370,6 +466,41 @@ class UserOrderSerializer(serializers.Serializer):
         return user
 
 
+class UserBulkOrderSerializer(serializers.Serializer):
+    department = serializers.IntegerField(
+        label='部门ID',
+        help_text='部门ID'
+    )
+    users = serializers.ListField(
+        child=serializers.IntegerField(),
+        label='用户ID列表',
+        help_text='按顺序排列的部门全部用户ID'
+    )
+    version = serializers.IntegerField(
+        label='排序版本',
+        help_text='读取排序时返回的版本号'
+    )
+
+    def validate_department(self, value):
+        try:
+            return models.Department.objects.get(pk=value)
+        except models.Department.DoesNotExist:
+            raise ValidationError('部门不存在')
+
+    def validate_users(self, value):
+        if len(set(value)) != len(value):
+            raise ValidationError('用户ID重复')
+        return value
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        department = validated_data['department']
+        department.set_user_order(validated_data['users'], validated_data['version'])
+        return department
+
+
 class UserLoginLogSerializer(serializers.ModelSerializer):
     user_info = UserMinSerializer(source='user', read_only=True)
 
@@ -386,6 +517,66 @@ class UserLoginLogSerializer(serializers.ModelSerializer):
         )
 
 
+class UserLoginStatQuerySerializer(serializers.Serializer):
+    PERIOD_CHOICES = (
+        ('day', '按天'),
+        ('week', '按周'),
+    )
+    department = serializers.PrimaryKeyRelatedField(
+        queryset=models.Department.objects.all(),
+        required=False,
+        help_text='部门，统计该部门及其所有下级部门'
+    )
+    start = serializers.DateField(required=False, help_text='开始日期，默认为结束日期前6天')
+    end = serializers.DateField(required=False, help_text='结束日期，默认为今天')
+    period = serializers.ChoiceField(choices=PERIOD_CHOICES, default='day', help_text='统计周期')
+    login_type = serializers.CharField(required=False, help_text='登录方式')
+    by_department = serializers.BooleanField(default=False, help_text='按部门分组')
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
+class UserPickerQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(help_text='姓名、用户名、手机号或姓名拼音首字母的前缀')
+    limit = serializers.IntegerField(default=20, min_value=1, max_value=100, help_text='最多返回的用户数')
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
+class SMSJobSerializer(serializers.ModelSerializer):
+    """群发短信"""
+    params = serializers.ListField(
+        child=serializers.CharField(), source='param_list', required=False, help_text='模板参数'
+    )
+
+    class Meta:
+        model = models.SMSJob
+        fields = (
+            'pk',
+            'template_id',
+            'params',
+            'department',
+            'func_groups',
+            'category',
+            'state',
+            'total',
+            'sent',
+            'failed',
+            'create_user',
+            'create_time',
+            'finish_time',
+        )
+        read_only_fields = ('state', 'total', 'sent', 'failed', 'create_user', 'create_time', 'finish_time')
+
+
 class UserRequireSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.UserRequire
@@ -480,6 +671,28 @@ class UserRequirePassSerializer(UserRequireSerializer):
         return instance
 
 
+class UserRequireBulkPassSerializer(serializers.Serializer):
+    requires = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        label='申请ID列表',
+        help_text='要通过的用户申请ID列表，每次最多 USER_REQUIRE_BULK_PASS_MAX 条'
+    )
+
+    def validate_requires(self, value):
+        # 密码哈希在请求内同步计算，数量过多时请求会超时
+        limit = getattr(settings, 'USER_REQUIRE_BULK_PASS_MAX', 100)
+        if len(value) > limit:
+            raise ValidationError('每次最多通过 {} 条申请，请分批提交'.format(limit))
+        return value
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
 class LeaveRequireSerializer(serializers.ModelSerializer):
     user_info = GroupUserSerializer(source='user', read_only=True)
 
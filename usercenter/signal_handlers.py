@@ -1,11 +1,175 @@
+from django.apps import apps
 from django.contrib.auth.signals import user_logged_in
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
+from mptt.signals import node_moved
 
 from . import models
+from .cache import DEPARTMENT_TREE_VERSION, count_version_name, invalidate_func_perms, invalidate_version
+from .loginlog import writer as login_log_writer
+from . import picker, search
 
 @receiver(user_logged_in)
 def add_user_login_log(sender, request, user, **kwargs):
-    models.UserLoginLog.objects.create(
+    login_log_writer.put(models.UserLoginLog(
         user=user, username=user.username, full_name=user.full_name,
-        ipaddress=request.META.get('REMOTE_ADDR')
-    )
+        ipaddress=request.META.get('REMOTE_ADDR'), login_time=timezone.now()
+    ))
+
+
+# 功能权限缓存失效
+def _group_user_pks(group_pks):
+    return models.User.objects.filter(func_groups__in=group_pks).values_list('pk', flat=True)
+
+
+def _permission_user_pks(permission_pks):
+    return models.User.objects.filter(
+        Q(func_user_permissions__in=permission_pks) | Q(func_groups__permissions__in=permission_pks)
+    ).values_list('pk', flat=True)
+
+
+def _m2m_invalidate(instance, action, reverse, pk_set, forward_users, reverse_users):
+    # forward_users/reverse_users 根据正向/反向一端的主键取受影响的用户
+    # 反向 clear 时 pk_set 为空，需在清除前记录受影响用户
+    if action == 'pre_clear' and reverse:
+        instance._func_perm_users = list(reverse_users([instance.pk]))
+    elif action == 'post_clear' and reverse:
+        invalidate_func_perms(getattr(instance, '_func_perm_users', []))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            invalidate_func_perms(forward_users(pk_set))
+        else:
+            invalidate_func_perms(forward_users([instance.pk]))
+
+
+@receiver(m2m_changed, sender=models.FuncGroup.permissions.through)
+def group_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _m2m_invalidate(instance, action, reverse, pk_set, _group_user_pks, _permission_user_pks)
+
+
+@receiver(m2m_changed, sender=models.User.func_groups.through)
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _m2m_invalidate(instance, action, reverse, pk_set, list, _group_user_pks)
+
+
+@receiver(m2m_changed, sender=models.User.func_user_permissions.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _m2m_invalidate(instance, action, reverse, pk_set, list, _permission_user_pks)
+
+
+@receiver(post_save, sender=models.FuncPermission)
+def func_permission_saved(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_func_perms(_permission_user_pks([instance.pk]))
+
+
+@receiver(post_save, sender=models.FuncGroup)
+def func_group_saved(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_func_perms(_group_user_pks([instance.pk]))
+
+
+@receiver(pre_delete, sender=models.FuncPermission)
+def func_permission_pre_delete(sender, instance, **kwargs):
+    instance._func_perm_users = list(_permission_user_pks([instance.pk]))
+
+
+@receiver(pre_delete, sender=models.FuncGroup)
+def func_group_pre_delete(sender, instance, **kwargs):
+    instance._func_perm_users = list(_group_user_pks([instance.pk]))
+
+
+@receiver(post_delete, sender=models.FuncPermission)
+@receiver(post_delete, sender=models.FuncGroup)
+def func_perm_deleted(sender, instance, **kwargs):
+    invalidate_func_perms(getattr(instance, '_func_perm_users', []))
+
+
+# 部门树缓存失效
+@receiver(post_save, sender=models.Department)
+@receiver(post_delete, sender=models.Department)
+@receiver(node_moved, sender=models.Department)
+def department_tree_changed(sender, instance, **kwargs):
+    invalidate_version(DEPARTMENT_TREE_VERSION)
+
+
+# 分页总数缓存失效，批量写入的路径需自行调用 invalidate_version
+# 只连接到列表接口的模型，不带 sender 的接收器会使所有模型的批量删除退化为逐行删除
+COUNTED_MODELS = (
+    models.User, models.Department, models.FuncGroup, models.FuncPermission, models.UserDepChange,
+    models.UserRequire, models.LeaveRequire, models.SMSJob,
+)
+
+
+# 列表接口不能按这些字段过滤，只修改这些字段时总数不变，登录时更新 last_login 不使缓存失效
+COUNT_IGNORED_FIELDS = {
+    models.User: frozenset(('last_login', 'password', 'wechart_oid')),
+}
+
+
+def count_changed(sender, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= COUNT_IGNORED_FIELDS.get(sender, frozenset()):
+        return
+    invalidate_version(count_version_name(sender))
+
+
+for _model in COUNTED_MODELS:
+    post_save.connect(count_changed, sender=_model, dispatch_uid='usercenter_count_saved_%s' % _model.__name__)
+    post_delete.connect(count_changed, sender=_model, dispatch_uid='usercenter_count_deleted_%s' % _model.__name__)
+
+
+@receiver(m2m_changed, sender=models.User.func_groups.through)
+@receiver(m2m_changed, sender=models.User.category.through)
+def user_relation_changed(sender, action, **kwargs):
+    # 用户列表按角色、分类过滤时，总数随关联变化
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_version(count_version_name(models.User))
+
+
+# 搜索词元维护
+def search_object_saved(sender, instance, update_fields=None, raw=False, **kwargs):
+    if not raw:
+        search.index_object(instance, update_fields)
+
+
+def search_object_deleted(sender, instance, **kwargs):
+    search.unindex_object(instance)
+
+
+for _label in search.SEARCH_FIELDS:
+    _model = apps.get_model(_label)
+    post_save.connect(search_object_saved, sender=_model, dispatch_uid='usercenter_search_saved_%s' % _label)
+    post_delete.connect(search_object_deleted, sender=_model, dispatch_uid='usercenter_search_deleted_%s' % _label)
+
+
+# 用户选择器索引变更
+@receiver(post_save, sender=models.User)
+def picker_user_saved(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and not set(update_fields) & set(picker.PICKER_USER_FIELDS)):
+        return
+    picker.record_change('user', [instance.pk])
+
+
+@receiver(post_delete, sender=models.User)
+def picker_user_deleted(sender, instance, **kwargs):
+    picker.record_change('user', [instance.pk])
+
+
+@receiver(post_save, sender=models.Department)
+@receiver(post_delete, sender=models.Department)
+def picker_department_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        picker.record_change('department', [instance.pk])
+
+
+# 用户部门任职区间
+@receiver(post_save, sender=models.User)
+def membership_user_saved(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    # 与数据库中的当前区间对比，内存中的实例可能早于其他保存或批量调动加载
+    if raw or (update_fields is not None and 'department' not in update_fields):
+        return
+    if created and instance.department_id is None:
+        return
+    models.DepartmentMembership.record_moves([(instance.pk, instance.department_id)])
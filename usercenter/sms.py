@@ -0,0 +1,247 @@
+import json
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('restapi')
+
+
+def generate_code(length=6):
+    """生成数字验证码"""
+    rand = random.SystemRandom()
+    return "".join(str(rand.randint(0, 9)) for i in range(length))
+
+
+class BaseSMSBackend(object):
+    """短信发送后端"""
+    # 一次请求最多发送的号码数
+    batch_size = 1
+
+    def send_code(self, phone, code):
+        """发送验证码，返回 (是否成功, 说明)"""
+        raise NotImplementedError
+
+    def send_template(self, phone, template_id, params):
+        """发送模板短信，返回 (是否成功, 说明)"""
+        raise NotImplementedError
+
+    def send_batch(self, phones, template_id, params):
+        """向不超过 batch_size 个号码发送模板短信，返回 {手机号: (是否成功, 说明)}"""
+        return {phone: self.send_template(phone, template_id, params) for phone in phones}
+
+
+class JuheSMSBackend(BaseSMSBackend):
+    """聚合数据短信，复用 HTTP 长连接，带超时和重试"""
+
+    def __init__(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.url = getattr(settings, 'SMS_URL_JUHE', None)
+        self.appkey = getattr(settings, 'SMS_APPKEY_JUHE', None)
+        self.tpl_id = getattr(settings, 'SMS_TPL_ID_JUHE', None)
+        self.timeout = getattr(settings, 'SMS_TIMEOUT', 5)
+        # 只重试连接失败和网关错误，读超时不重试以免重复发送
+        retry = Retry(total=getattr(settings, 'SMS_RETRIES', 2), read=0, backoff_factor=0.3,
+                      status_forcelist=(502, 503, 504))
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=getattr(settings, 'SMS_MAX_WORKERS', 4),
+                                                  max_retries=retry))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=getattr(settings, 'SMS_MAX_WORKERS', 4),
+                                                   max_retries=retry))
+
+    def send_code(self, phone, code):
+        return self.send_template(phone, self.tpl_id, ['code=' + code])
+
+    def send_template(self, phone, template_id, params):
+        """params 为 "变量名=值" 列表"""
+        import requests
+        if not all([self.url, self.appkey, template_id]):
+            logger.error('短信验证码配置错误')
+            return False, '短信验证码配置错误'
+        tpl_value = '&'.join('#{}#={}'.format(*param.split('=', 1)) for param in params)
+        params = {'mobile': phone, 'tpl_id': template_id, 'tpl_value': tpl_value, 'key': self.appkey}
+        try:
+            ret_json = self.session.get(self.url, params=params, timeout=self.timeout).json()
+        except (requests.RequestException, ValueError) as e:
+            return False, str(e)
+        if ret_json.get('error_code') == 0:
+            return True, ''
+        return False, json.dumps(ret_json, ensure_ascii=False)
+
+
+class TencentSMSBackend(BaseSMSBackend):
+    """腾讯云短信"""
+    batch_size = 200
+
+    def send_code(self, phone, code):
+        return self.send_template(phone, getattr(settings, 'SMS_TPL_ID_TENCENT', None), [code])
+
+    def send_template(self, phone, template_id, params):
+        return self.send_batch([phone], template_id, params)[phone]
+
+    def send_batch(self, phones, template_id, params):
+        from .auth_tencent import send_sms
+        return send_sms(phones, template_id, params)
+
+
+class LocalSMSBackend(BaseSMSBackend):
+    """本地短信后端，不实际发送，用于测试；fail_phones 中的号码发送失败"""
+    batch_size = 100
+    outbox = []
+    fail_phones = set()
+
+    def send_code(self, phone, code):
+        return self.send_template(phone, 'code', [code])
+
+    def send_template(self, phone, template_id, params):
+        if phone in self.fail_phones:
+            return False, '发送失败'
+        self.outbox.append((phone, template_id, list(params)))
+        return True, ''
+
+
+SMS_BACKENDS = {
+    'JUHE': JuheSMSBackend,
+    'TENCENT': TencentSMSBackend,
+    'LOCAL': LocalSMSBackend,
+}
+
+_backends = {}
+_lock = threading.Lock()
+
+
+def get_backend():
+    """按 settings.SMS_BACKEND（类路径）或 settings.SMS_TYPE 返回共享的短信后端"""
+    name = getattr(settings, 'SMS_BACKEND', None) or getattr(settings, 'SMS_TYPE', 'JUHE')
+    backend = _backends.get(name)
+    if backend is None:
+        with _lock:
+            backend = _backends.get(name)
+            if backend is None:
+                backend_class = SMS_BACKENDS.get(name) or import_string(name)
+                backend = _backends[name] = backend_class()
+    return backend
+
+
+class SMSDispatcher(object):
+    """
+    短信异步发送
+    有界线程池，排队数超过 max_pending 时拒绝；settings.SMS_ASYNC 为 False 时同步发送
+    """
+
+    def __init__(self, max_workers=4, max_pending=1000):
+        self.max_workers = max_workers
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers)
+        return self._executor
+
+    def submit(self, func, *args):
+        """提交发送任务，队列已满时返回 False"""
+        if not getattr(settings, 'SMS_ASYNC', True):
+            func(*args)
+            return True
+        if not self._pending.acquire(blocking=False):
+            logger.error('短信发送队列已满')
+            return False
+        self._get_executor().submit(self._run, func, *args)
+        return True
+
+    def _run(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('短信发送异常')
+        finally:
+            self._pending.release()
+            close_old_connections()
+
+
+dispatcher = SMSDispatcher(
+    max_workers=getattr(settings, 'SMS_MAX_WORKERS', 4),
+    max_pending=getattr(settings, 'SMS_MAX_PENDING', 1000),
+)
+
+
+def _send_code(phone, code):
+    state, detail = get_backend().send_code(phone, code)
+    logger.info('{}: {}'.format(phone, state))
+    code_sent(phone, code, state, detail)
+
+
+def code_sent(phone, code, state, detail):
+    """验证码发送结果回调，发送失败时记录并作废验证码以便重新发送"""
+    from .models import SMSRecord
+    from .otp import get_otp_store
+    if state:
+        return
+    logger.error('短信验证码发送失败 {}: {}'.format(phone, detail))
+    SMSRecord.objects.create(phone=phone, success=False, detail=detail)
+    get_otp_store().discard(phone, code)
+
+
+def dispatch_code(phone, code):
+    """异步发送验证码，队列已满时返回 False"""
+    return dispatcher.submit(_send_code, phone, code)
+
+
+# 群发短信任务在单独的线程池中执行，不占用验证码发送线程
+job_dispatcher = SMSDispatcher(
+    max_workers=getattr(settings, 'SMS_JOB_MAX_WORKERS', 1),
+    max_pending=getattr(settings, 'SMS_JOB_MAX_PENDING', 100),
+)
+
+
+def run_job(job_pk):
+    """执行群发短信任务，按后端的 batch_size 分批，最多 SMS_JOB_CONCURRENCY 批同时发送"""
+    from django.db.models import F
+    from django.utils import timezone
+    from .models import SMSJob, SMSRecord
+    job = SMSJob.objects.select_related('department').get(pk=job_pk)
+    phones = job.get_recipient_phones()
+    SMSJob.objects.filter(pk=job.pk).update(state='发送中', total=len(phones))
+    backend = get_backend()
+    params = job.param_list
+    batches = [phones[i:i + backend.batch_size] for i in range(0, len(phones), backend.batch_size)]
+
+    def send(batch):
+        try:
+            result = backend.send_batch(batch, job.template_id, params)
+        except Exception as e:
+            logger.exception('群发短信异常')
+            result = {phone: (False, str(e)) for phone in batch}
+        try:
+            SMSRecord.objects.bulk_create(
+                SMSRecord(job_id=job.pk, phone=phone, success=state, detail=detail)
+                for phone, (state, detail) in result.items()
+            )
+            sent = sum(1 for state, detail in result.values() if state)
+            SMSJob.objects.filter(pk=job.pk).update(sent=F('sent') + sent, failed=F('failed') + len(result) - sent)
+        finally:
+            close_old_connections()
+
+    try:
+        with ThreadPoolExecutor(getattr(settings, 'SMS_JOB_CONCURRENCY', 2)) as executor:
+            list(executor.map(send, batches))
+    except Exception:
+        logger.exception('群发短信任务失败')
+        SMSJob.objects.filter(pk=job.pk).update(state='失败', finish_time=timezone.now())
+        return
+    SMSJob.objects.filter(pk=job.pk).update(state='已完成', finish_time=timezone.now())
+
+
+def dispatch_job(job):
+    """提交群发短信任务，队列已满时返回 False"""
+    return job_dispatcher.submit(run_job, job.pk)
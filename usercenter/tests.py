@@ -1,3 +1,445 @@
+import datetime
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from . import api
+from . import models
+from . import otp
+from . import picker
+from . import scope
+from . import search
+from .bulk import transfer_users
+from .cache import count_version_name, get_func_perms, get_version
+from .filters import UserFilterSet
+from .pagination import UCPageNumberPagination
+
+
+class UserListQueryCountTest(TestCase):
+    """用户列表查询数与页大小无关"""
+
+    def setUp(self):
+        cache.clear()
+        department = models.Department.objects.create(name='总部')
+        permission = models.FuncPermission.objects.create(name='查看', codename='view')
+        group = models.FuncGroup.objects.create(name='店长')
+        group.permissions.add(permission)
+        self.department = department
+        self.admin = models.User.objects.create_user('admin', 'admin', department=department)
+        for i in range(30):
+            user = models.User.objects.create_user(
+                'user%s' % i, 'password', full_name='用户%s' % i, department=department
+            )
+            user.func_groups.add(group)
+            user.func_user_permissions.add(permission)
+            models.UserRequire.objects.create(
+                phone='1380000%04d' % i, full_name=user.full_name, group=group,
+                department=department, target_user=user,
+            )
+        self.view = api.UserViewSet.as_view({'get': 'list'}, pagination_class=UCPageNumberPagination)
+
+    def _list(self, page_size):
+        request = APIRequestFactory().get('/', {'pageSize': page_size})
+        force_authenticate(request, user=self.admin)
+        response = self.view(request)
+        response.render()
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def _count_queries(self, page_size):
+        with CaptureQueriesContext(connection) as context:
+            response = self._list(page_size)
+        self.assertEqual(len(response.data['data']), page_size)
+        return len(context.captured_queries)
+
+    def test_constant_queries(self):
+        # 第一次请求写入总数等缓存，之后的请求查询数固定
+        self._list(5)
+        self.assertEqual(self._count_queries(5), self._count_queries(25))
+        self.assertLessEqual(self._count_queries(25), 8)
+
+    def test_count_cache_invalidated(self):
+        count = self._list(5).data['count']
+        self.assertEqual(self._list(5).data['count'], count)
+        user = models.User.objects.create_user('new', 'password', department=self.department)
+        self.assertEqual(self._list(5).data['count'], count + 1)
+        user.delete()
+        self.assertEqual(self._list(5).data['count'], count)
+
+    def test_count_cache_kept_on_login(self):
+        name = count_version_name(models.User)
+        version = get_version(name)
+        self.admin.last_login = timezone.now()
+        self.admin.save(update_fields=['last_login'])
+        self.assertEqual(get_version(name), version)
+        self.admin.save(update_fields=['full_name'])
+        self.assertNotEqual(get_version(name), version)
+
+
+class CursorPaginationTest(TestCase):
+    """游标分页逐页读取不遗漏排序值相同的行"""
+
+    def setUp(self):
+        cache.clear()
+        self.admin = models.User.objects.create_user('admin', 'admin')
+        login_time = timezone.now().replace(microsecond=123456)
+        models.UserLoginLog.objects.bulk_create([
+            models.UserLoginLog(user=self.admin, username='admin%s' % i, login_time=login_time) for i in range(6)
+        ])
+        self.view = api.UserLoginLogViewSet.as_view({'get': 'list'})
+
+    def test_walk_all_pages(self):
+        usernames, cursor = [], ''
+        for i in range(10):
+            request = APIRequestFactory().get('/', {'cursor': cursor, 'pageSize': 2})
+            force_authenticate(request, user=self.admin)
+            response = self.view(request)
+            self.assertEqual(response.status_code, 200)
+            usernames.extend(row['username'] for row in response.data['data'])
+            cursor = response.data['next']
+            if not cursor:
+                break
+        self.assertEqual(sorted(usernames), ['admin%s' % i for i in range(6)])
+
+
+class DataScopeTest(TestCase):
+    """只能查看本部门及下级部门数据的用户看不到其他部门的用户"""
+
+    def setUp(self):
+        cache.clear()
+        picker.index.version = None
+        root = models.Department.objects.create(name='总部')
+        self.store = models.Department.objects.create(name='一店', parent=root)
+        self.other = models.Department.objects.create(name='二店', parent=root)
+        permission = models.FuncPermission.objects.create(name='本部门数据', codename=scope.DATA_SCOPE_DEPARTMENT)
+        self.manager = models.User.objects.create_user('manager', 'password', full_name='店长', department=self.store)
+        self.manager.func_user_permissions.add(permission)
+        self.inside = models.User.objects.create_user('inside', 'password', full_name='张三', department=self.store)
+        self.outside = models.User.objects.create_user('outside', 'password', full_name='张四', department=self.other)
+
+    def _get(self, view, params=None):
+        request = APIRequestFactory().get('/', params or {})
+        force_authenticate(request, user=self.manager)
+        return view(request)
+
+    def _send(self, method, view, data, format='json', **kwargs):
+        request = getattr(APIRequestFactory(), method)('/', data, format=format)
+        force_authenticate(request, user=self.manager)
+        return view(request, **kwargs)
+
+    def test_user_list(self):
+        view = api.UserViewSet.as_view({'get': 'list'}, pagination_class=UCPageNumberPagination)
+        response = self._get(view, {'pageSize': 10})
+        usernames = {row['username'] for row in response.data['data']}
+        self.assertEqual(usernames, {'manager', 'inside'})
+
+    def test_picker(self):
+        response = self._get(api.UserPickerView.as_view({'get': 'list'}), {'q': 'zs'})
+        self.assertEqual([row['pk'] for row in response.data], [self.inside.pk])
+
+    def test_roster(self):
+        view = api.DepartmentRosterView.as_view({'get': 'list'})
+        self.assertEqual(self._get(view, {'department': self.other.pk}).status_code, 403)
+        response = self._get(view, {'department': self.store.pk})
+        self.assertEqual({row['user'] for row in response.data}, {self.manager.pk, self.inside.pk})
+
+    def test_login_stat(self):
+        today = timezone.now()
+        models.UserLoginDaily.record([
+            (today, self.inside.pk, self.store.pk, 'PC'), (today, self.outside.pk, self.other.pk, 'PC'),
+        ])
+        view = api.UserLoginStatView.as_view({'get': 'list'})
+        self.assertEqual(self._get(view, {'department': self.other.pk}).status_code, 403)
+        response = self._get(view)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['count'] for row in response.data], [1])
+
+    def test_transfer(self):
+        request = APIRequestFactory().post(
+            '/', {'users': [self.outside.pk], 'department': self.store.pk}, format='json'
+        )
+        force_authenticate(request, user=self.manager)
+        response = api.UserTransferView.as_view({'post': 'create'})(request)
+        self.assertEqual(response.status_code, 403)
+        self.outside.refresh_from_db()
+        self.assertEqual(self.outside.department, self.other)
+
+    def test_user_create(self):
+        view = api.UserViewSet.as_view({'post': 'create'})
+        response = self._send('post', view, {'username': 'new', 'department': self.other.pk})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(models.User.objects.filter(username='new').exists())
+
+    def test_user_update(self):
+        view = api.UserViewSet.as_view({'patch': 'partial_update'})
+        response = self._send('patch', view, {'department': self.other.pk}, pk=self.inside.pk)
+        self.assertEqual(response.status_code, 403)
+        self.inside.refresh_from_db()
+        self.assertEqual(self.inside.department, self.store)
+
+    def test_user_order(self):
+        view = api.UserOrderView.as_view({'post': 'create'})
+        data = {'user': self.outside.pk, 'target': self.inside.pk, 'position': 'left'}
+        self.assertEqual(self._send('post', view, data).status_code, 403)
+
+    def test_user_bulk_order(self):
+        view = api.UserBulkOrderView.as_view({'post': 'create'})
+        data = {'department': self.other.pk, 'users': [self.outside.pk], 'version': self.other.user_sort_version}
+        self.assertEqual(self._send('post', view, data).status_code, 403)
+
+    def test_user_import(self):
+        upload = SimpleUploadedFile('users.csv', 'username,部门\nnew,总部/二店\n'.encode('utf-8'))
+        response = self._send('post', api.UserImportView.as_view({'post': 'create'}), {'file': upload}, 'multipart')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(models.User.objects.filter(username='new').exists())
+
+
+class OTPStoreTest(TestCase):
+    """验证码尝试次数用完后作废，但不能立即重发"""
+
+    def setUp(self):
+        cache.clear()
+        self.store = otp.CacheOTPStore()
+
+    def test_attempts_exhausted(self):
+        self.assertTrue(self.store.issue('13800000000', '111111'))
+        for i in range(self.store.max_attempts):
+            self.assertFalse(self.store.verify('13800000000', '000000'))
+        self.assertFalse(self.store.verify('13800000000', '111111'))
+        self.assertFalse(self.store.issue('13800000000', '222222'))
+
+    def test_demo_phone(self):
+        phone, code = next(iter(self.store.demo_codes.items()))
+        for i in range(self.store.max_attempts + 1):
+            self.assertFalse(self.store.verify(phone, '000000'))
+        self.assertTrue(self.store.verify(phone, code))
+        self.assertTrue(self.store.verify(phone, code))
+
+
+class SMSJobRecipientTest(TestCase):
+    """群发短信接收人一次查询取得，未选择的条件不限"""
+
+    def setUp(self):
+        root = models.Department.objects.create(name='总部')
+        self.store = models.Department.objects.create(name='一店', parent=root)
+        self.group = models.FuncGroup.objects.create(name='店长')
+        self.manager = models.User.objects.create_user(
+            'manager', 'password', mobile='13800000001', department=self.store
+        )
+        self.manager.func_groups.add(self.group)
+        models.User.objects.create_user('clerk', 'password', mobile='13800000002', department=self.store)
+        models.User.objects.create_user('staff', 'password', mobile='13800000003', department=root)
+
+    def test_recipients(self):
+        job = models.SMSJob.objects.create(template_id='1')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(job.get_recipient_phones()), 3)
+        job.department = self.store
+        job.save()
+        job = models.SMSJob.objects.get(pk=job.pk)
+        self.assertEqual(sorted(job.get_recipient_phones()), ['13800000001', '13800000002'])
+        job.func_groups.add(self.group)
+        with self.assertNumQueries(1):
+            self.assertEqual(job.get_recipient_phones(), ['13800000001'])
+
+
+class UserOrderTest(TestCase):
+    """用户排序：插入到目标之前或之后，没有空隙时重新编号，版本过期时返回 409"""
+
+    def setUp(self):
+        self.department = models.Department.objects.create(name='总部')
+        self.users = [
+            models.User.objects.create_user(username, 'password', department=self.department)
+            for username in ('a', 'b', 'c')
+        ]
+        models.User.objects.set_sort_order([user.pk for user in self.users])
+
+    def _order(self):
+        return list(self.department.users.order_by('sort_num', '-pk').values_list('username', flat=True))
+
+    def _version(self):
+        return models.Department.objects.get(pk=self.department.pk).user_sort_version
+
+    def test_move_before(self):
+        a, b, c = self.users
+        version = self._version()
+        c.move_to(a, 'left')
+        self.assertEqual(self._order(), ['c', 'a', 'b'])
+        self.assertEqual(self._version(), version + 1)
+
+    def test_move_after(self):
+        a, b, c = self.users
+        a.move_to(b, 'right')
+        self.assertEqual(self._order(), ['b', 'a', 'c'])
+        a.move_to(c, 'right')
+        self.assertEqual(self._order(), ['b', 'c', 'a'])
+
+    def test_gap_exhausted(self):
+        a, b, c = self.users
+        models.User.objects.set_sort_order([user.pk for user in self.users], gap=1)
+        c.move_to(b, 'left')
+        self.assertEqual(self._order(), ['a', 'c', 'b'])
+        sort_nums = list(self.department.users.order_by('sort_num').values_list('sort_num', flat=True))
+        self.assertEqual(len(set(sort_nums)), 3)
+        self.assertGreater(sort_nums[1] - sort_nums[0], 1)
+
+    def test_stale_version(self):
+        a, b, c = self.users
+        version = self._version()
+        a.move_to(c, 'right')
+        request = APIRequestFactory().post('/', {
+            'department': self.department.pk, 'users': [a.pk, b.pk, c.pk], 'version': version,
+        }, format='json')
+        force_authenticate(request, user=a)
+        response = api.UserBulkOrderView.as_view({'post': 'create'})(request)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self._order(), ['b', 'c', 'a'])
+
+
+class SearchIndexTest(TestCase):
+    """n-gram 词元索引随用户保存、删除维护，完全匹配的排在前面"""
+
+    def setUp(self):
+        self.wang = models.User.objects.create_user('wang', 'password', full_name='王小明', mobile='13912345678')
+        self.wangwu = models.User.objects.create_user('wangwu', 'password', full_name='王五')
+
+    def _search(self, *terms):
+        return list(search.search(models.User.objects.all(), terms).values_list('username', flat=True))
+
+    def test_short_and_long_terms(self):
+        self.assertEqual(self._search('小明'), ['wang'])
+        self.assertEqual(self._search('2345678'), ['wang'])
+        self.assertEqual(self._search('王', '五'), ['wangwu'])
+        self.assertEqual(self._search('2345679'), [])
+
+    def test_exact_match_first(self):
+        self.assertEqual(self._search('wang'), ['wang', 'wangwu'])
+        self.assertEqual(self._search('wangwu'), ['wangwu'])
+
+    def test_signal_upkeep(self):
+        self.wang.full_name = '李雷'
+        self.wang.save()
+        self.assertEqual(self._search('小明'), [])
+        self.assertEqual(self._search('李雷'), ['wang'])
+        self.wang.save(update_fields=['last_login'])
+        self.assertEqual(self._search('李雷'), ['wang'])
+        pk = self.wang.pk
+        self.wang.delete()
+        self.assertFalse(models.SearchToken.objects.filter(model='usercenter.user', object_id=pk).exists())
+
+
+class FuncPermCacheTest(TestCase):
+    """角色、权限变更后用户的功能权限缓存失效"""
+
+    def setUp(self):
+        cache.clear()
+        self.permission = models.FuncPermission.objects.create(name='查看', codename='view')
+        self.group = models.FuncGroup.objects.create(name='店长')
+        self.group.permissions.add(self.permission)
+        self.user = models.User.objects.create_user('user', 'password')
+        self.user.func_groups.add(self.group)
+
+    def _codenames(self):
+        return get_func_perms(self.user)['codenames']
+
+    def test_cached(self):
+        self.assertEqual(self._codenames(), {'view'})
+        with self.assertNumQueries(0):
+            self.assertEqual(self._codenames(), {'view'})
+
+    def test_group_permissions_changed(self):
+        self.assertEqual(self._codenames(), {'view'})
+        self.group.permissions.remove(self.permission)
+        self.assertEqual(self._codenames(), set())
+        self.permission.funcgroup_set.add(self.group)
+        self.assertEqual(self._codenames(), {'view'})
+
+    def test_user_groups_changed(self):
+        self.assertEqual(self._codenames(), {'view'})
+        self.group.user_set.clear()
+        self.assertEqual(self._codenames(), set())
+
+    def test_permission_changed(self):
+        self.assertEqual(self._codenames(), {'view'})
+        self.permission.codename = 'edit'
+        self.permission.save()
+        self.assertEqual(self._codenames(), {'edit'})
+        self.permission.delete()
+        self.assertEqual(self._codenames(), set())
+
+
+class TransferUsersTest(TestCase):
+    """批量调动部门：一次更新部门，写入变更记录和任职区间"""
+
+    def setUp(self):
+        root = models.Department.objects.create(name='总部')
+        self.store = models.Department.objects.create(name='一店', parent=root)
+        self.other = models.Department.objects.create(name='二店', parent=root)
+        self.moved = models.User.objects.create_user('moved', 'password', department=self.store)
+        self.stayed = models.User.objects.create_user('stayed', 'password', department=self.other)
+        self.unassigned = models.User.objects.create_user('unassigned', 'password')
+
+    def test_transfer(self):
+        pks = [self.moved.pk, self.stayed.pk, self.unassigned.pk]
+        self.assertEqual(transfer_users(pks, self.other), 2)
+        self.assertEqual(set(models.User.objects.filter(pk__in=pks).values_list('department', flat=True)),
+                         {self.other.pk})
+        changes = models.UserDepChange.objects.values_list('user', 'old_department', 'new_department')
+        self.assertEqual(list(changes), [(self.moved.pk, self.store.pk, self.other.pk)])
+        current = models.DepartmentMembership.objects.filter(valid_to__isnull=True)
+        self.assertEqual(set(current.values_list('user', 'department')),
+                         {(pk, self.other.pk) for pk in pks})
+        self.assertEqual(models.Department.objects.get(pk=self.store.pk).user_sort_version, 1)
+        self.assertEqual(transfer_users(pks, self.other), 0)
+
+
+class DepartmentMembershipTest(TestCase):
+    """任职区间从入职时间开始，历史日期按区间过滤用户"""
+
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.root = models.Department.objects.create(name='总部')
+        self.store = models.Department.objects.create(name='一店', parent=self.root)
+        self.other = models.Department.objects.create(name='二店', parent=self.root)
+        self.user = models.User.objects.create_user(
+            'user', 'password', department=self.store, date_joined=timezone.now() - datetime.timedelta(days=30)
+        )
+        self.fresh = models.User.objects.create_user('fresh', 'password', department=self.other)
+        models.DepartmentMembership.record_moves([(self.user.pk, self.other.pk)], self._days_ago(10))
+
+    def _days_ago(self, days):
+        return self.today - datetime.timedelta(days=days)
+
+    def _filter(self, **data):
+        filterset = UserFilterSet(data=data, queryset=models.User.objects.all())
+        self.assertTrue(filterset.is_valid())
+        return set(filterset.qs.values_list('username', flat=True))
+
+    def test_record_moves(self):
+        joined = self.user.date_joined
+        joined = (timezone.localtime(joined) if timezone.is_aware(joined) else joined).date()
+        intervals = [(self.store.pk, joined, self._days_ago(10)), (self.other.pk, self._days_ago(10), None)]
+        memberships = self.user.memberships.order_by('valid_from').values_list('department', 'valid_from', 'valid_to')
+        self.assertEqual(list(memberships), intervals)
+        models.DepartmentMembership.record_moves([(self.user.pk, self.other.pk)])
+        self.assertEqual(list(memberships), intervals)
+
+    def test_as_of(self):
+        self.assertEqual(self._filter(as_of=self._days_ago(20), as_of_department=self.store.pk), {'user'})
+        self.assertEqual(self._filter(as_of=self._days_ago(5), as_of_department=self.store.pk), set())
+        self.assertEqual(self._filter(as_of=self._days_ago(5), as_of_department=self.other.pk), {'user'})
+        self.assertEqual(self._filter(as_of=self._days_ago(20)), {'user'})
+        self.assertEqual(self._filter(as_of=self._days_ago(20), as_of_end=self.today), {'user', 'fresh'})
+        self.assertEqual(
+            self._filter(as_of=self.today, as_of_department=self.root.pk, as_of_subtree=True), {'user', 'fresh'}
+        )
+        self.assertEqual(self._filter(as_of=self.today, as_of_department=self.root.pk), set())
 
-# Create your tests here.
+    def test_as_of_required(self):
+        filterset = UserFilterSet(data={'as_of_department': self.store.pk}, queryset=models.User.objects.all())
+        self.assertFalse(filterset.is_valid())
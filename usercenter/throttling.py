@@ -0,0 +1,138 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+# 默认速率，可在 REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] 中按 "<throttle_scope>.<ip|phone>" 覆盖
+DEFAULT_RATES = {
+    'phoneauth.ip': '10/min',
+    'phoneauth.phone': '5/hour',
+    'phonelogin.ip': '20/min',
+    'phonelogin.phone': '10/hour',
+    'wxabind.ip': '10/min',
+    'wxabind.phone': '10/hour',
+    'userrequire.ip': '10/hour',
+    'userrequire.phone': '5/day',
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    令牌桶限流
+    按视图的 throttle_scope 和 key_kind 读取速率，"10/min" 表示桶容量10，每分钟补满
+    settings.THROTTLE_STORE 为 redis 时用 Lua 脚本原子地更新令牌桶；
+    为 cache（默认）时使用滑动窗口计数，按上一窗口计数的剩余比例加上当前窗口计数估算，
+    计数用 cache.add + cache.incr 原子地更新，不会出现固定窗口边界处两倍速率的突发
+    """
+    cache = default_cache
+    cache_format = 'usercenter:throttle:%(scope)s:%(ident)s'
+    key_kind = None
+
+    TAKE_SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local period = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local data = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(data[1]) or capacity
+    local updated = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * capacity / period)
+    if tokens < 1 then
+        return tostring((1 - tokens) * period / capacity)
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tokens - 1, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(period))
+    return 0
+    """
+    _take_script = None
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def get_ident_value(self, request):
+        raise NotImplementedError
+
+    def get_rate(self, scope):
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope, DEFAULT_RATES.get(scope))
+        if rate is None:
+            return None
+        num, period = rate.split('/')
+        return int(num), PERIODS[period[0]]
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        if not scope:
+            return True
+        scope = '%s.%s' % (scope, self.key_kind)
+        rate = self.get_rate(scope)
+        ident = self.get_ident_value(request)
+        if rate is None or not ident:
+            return True
+        capacity, period = rate
+        key = self.cache_format % {'scope': scope, 'ident': ident}
+        if getattr(settings, 'THROTTLE_STORE', 'cache') == 'redis':
+            self.wait_seconds = self.take_redis(key, capacity, period)
+        else:
+            self.wait_seconds = self.take_cache(key, capacity, period)
+        return self.wait_seconds is None
+
+    @classmethod
+    def take_redis(cls, key, capacity, period):
+        """取一个令牌，返回需要等待的秒数，取到时返回 None"""
+        if cls._take_script is None:
+            from .clients import get_redis
+            TokenBucketThrottle._take_script = get_redis().register_script(cls.TAKE_SCRIPT)
+        wait = cls._take_script(keys=[key], args=[capacity, period, time.time()])
+        return float(wait) if float(wait) > 0 else None
+
+    def take_cache(self, key, capacity, period):
+        """滑动窗口计数，返回需要等待的秒数，通过时返回 None"""
+        now = time.time()
+        window = int(now // period)
+        current_key = '%s:%s' % (key, window)
+        previous = self.cache.get('%s:%s' % (key, window - 1), 0)
+        self.cache.add(current_key, 0, period * 2)
+        try:
+            count = self.cache.incr(current_key)
+        except ValueError:
+            # 键在 add 和 incr 之间过期
+            self.cache.add(current_key, 1, period * 2)
+            count = 1
+        remaining = (window + 1) * period - now
+        estimate = previous * remaining / period + count
+        if estimate <= capacity:
+            return None
+        # 被拒绝的请求不计数
+        try:
+            self.cache.decr(current_key)
+        except ValueError:
+            pass
+        if not previous:
+            return remaining
+        return min(remaining, (estimate - capacity) * period / previous)
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class IPTokenBucketThrottle(TokenBucketThrottle):
+    """按客户端IP限流"""
+    key_kind = 'ip'
+
+    def get_ident_value(self, request):
+        return self.get_ident(request)
+
+
+class PhoneTokenBucketThrottle(TokenBucketThrottle):
+    """按请求中的手机号限流"""
+    key_kind = 'phone'
+
+    def get_ident_value(self, request):
+        # 请求体为 JSON 数组或其他非对象值时不按手机号限流
+        if not isinstance(request.data, dict):
+            return None
+        phone = request.data.get('phone')
+        return phone.strip() if isinstance(phone, str) else None
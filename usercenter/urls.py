@@ -7,21 +7,30 @@ from . import views
 
 router = routers.DefaultRouter()
 router.register(r'user', api.UserViewSet)
+router.register(r'userimport', api.UserImportView)
+router.register(r'userexport', api.UserExportView)
 router.register(r'userorder', api.UserOrderView)
+router.register(r'userbulkorder', api.UserBulkOrderView)
+router.register(r'userpicker', api.UserPickerView)
 router.register(r'group', api.GroupViewSet)
 router.register(r'permissions', api.PermissionViewSet)
 router.register(r'department', api.TreeDepartmentViewSet)
 router.register(r'flatdepartment', api.DepartmentViewSet)
 router.register(r'departmentmove', api.DepartmentMoveView)
+router.register(r'departmentroster', api.DepartmentRosterView)
 router.register(r'userdepchange', api.UserDepChangeViewSet)
+router.register(r'usertransfer', api.UserTransferView)
 router.register(r'changepwd', api.ChangePasswordApi)
 router.register(r'myinfo', api.MyInfoViewSet)
 router.register(r'userloginlog', api.UserLoginLogViewSet)
+router.register(r'userloginstat', api.UserLoginStatView)
+router.register(r'smsjob', api.SMSJobViewSet)
 router.register(r'userrequire', api.UserRequireViewSet)
 router.register(r'userrequirecreate', api.UserRequireCreateView)
 # router.register(r'userrequiredepartmentlist', api.UserRequireDepartmentListView)
 # router.register(r'userrequiregrouplist', api.UserRequireGroupListView)
 router.register(r'userrequirepass', api.UserRequirePassView)
+router.register(r'userrequirebulkpass', api.UserRequireBulkPassView)
 # router.register(r'leaverequire', api.LeaveRequireViewSet)
 # router.register(r'leaverequirepass', api.LeaveRequirePassView)
 